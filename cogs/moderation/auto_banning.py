@@ -1,36 +1,760 @@
 import os
-from dotenv import load_dotenv
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
+import aiohttp
+import asyncio
 import datetime
+from collections import deque, OrderedDict
+import hashlib
+import io
+import json
+import re
+import shutil
+import tempfile
+import urllib.parse
+try:
+    # optional: only needed to match re-encoded copies of the same image
+    from PIL import Image
+except ImportError:
+    Image = None
+from config import Config
+from state_files import QueuedFileWriter, append_to_file, write_file_atomically
 
 
-load_dotenv()
-SERVER_ID = int(os.getenv('SERVER_ID'))
-BANNED_ROLE_ID = int(os.getenv('BANNED_ROLE_ID'))
-ADMINISTRATION_ROLES_IDS = [int(role_id) for role_id in os.getenv('ADMINISTRATION_ROLES_IDS').split(',')]
-REASON_OF_BAN_CHANNEL_ID = int(os.getenv('REASON_OF_BAN_CHANNEL_ID'))
-AUTO_BAN_NUMBER_OF_REPEAT_IN_SAME_CHANNEL = int(os.getenv('AUTO_BAN_NUMBER_OF_REPEAT_IN_SAME_CHANNEL'))
-AUTO_BAN_NUMBER_OF_DIFFERENT_CHANNEL_REPEAT = int(os.getenv('AUTO_BAN_NUMBER_OF_DIFFERENT_CHANNEL_REPEAT'))
-AUTO_BAN_CHARACTER_LENGTH_MINIMUM = int(os.getenv('AUTO_BAN_CHARACTER_LENGTH_MINIMUM'))
-AUTO_BAN_DETECTION_PERIOD_MINUTES = int(os.getenv('AUTO_BAN_DETECTION_PERIOD_MINUTES'))
-AUTO_BAN_NEW_USER_THRESHOLD_SECONDS = int(os.getenv('AUTO_BAN_NEW_USER_THRESHOLD_SECONDS'))
+# The ids and thresholds (the environment variables in README.md) are read from bot.config whenever they are needed,
+# so a reloaded configuration takes effect right away. See on_config_reload for the state worked out from them.
+
+# How on_message treats a member's messages. Members not in the classification cache are MEMBER_NORMAL.
+MEMBER_NORMAL = 'normal'
+# administrators, and members already holding the banned role: messages are ignored
+MEMBER_EXEMPT = 'exempt'
+# members the cog is banning right now: messages sent before the ban is confirmed are deleted
+MEMBER_BANNED_PENDING = 'banned_pending'
+
+# Discord only bulk deletes messages younger than 14 days, up to 100 at a time. Leave a margin for clock skew
+BULK_DELETE_MAX_AGE_SECONDS = 14 * 24 * 60 * 60 - 60
+BULK_DELETE_MAX_MESSAGES = 100
+# How many channels to delete messages from at the same time. discord.py waits out rate limits per route itself,
+# this just keeps a ban in many channels from queueing a burst of requests all at once.
+DELETION_CHANNEL_CONCURRENCY = 4
+
+# Most distinct messages/links the guild-wide duplicate index remembers at once, least recently posted dropped first
+CROSS_USER_INDEX_MAX_KEYS = 20000
+# Near-duplicate matching compares messages by their overlapping SIMHASH_SHINGLE_LENGTH character pieces.
+# The guild-wide near-duplicate index remembers at most NEAR_DUPLICATE_INDEX_MAX_ENTRIES messages at once.
+SIMHASH_SHINGLE_LENGTH = 4
+NEAR_DUPLICATE_INDEX_MAX_ENTRIES = 20000
+
+# Attachments are compared by a hash of their first ATTACHMENT_PARTIAL_HASH_BYTES bytes (plus size and filename),
+# or by a perceptual hash for images of up to ATTACHMENT_PERCEPTUAL_HASH_MAX_BYTES and
+# ATTACHMENT_PERCEPTUAL_HASH_MAX_PIXELS when Pillow is installed (bigger images would take too much memory to decode).
+# Images whose perceptual hashes differ in at most IMAGE_HASH_MAX_DISTANCE bits count as the same image. Images with
+# less than IMAGE_HASH_MIN_CONTRAST between their lightest and darkest (shrunk) pixels, like blank or solid colour
+# images, all hash alike, so they are compared by their bytes instead.
+ATTACHMENT_PARTIAL_HASH_BYTES = 64 * 1024
+ATTACHMENT_PERCEPTUAL_HASH_MAX_BYTES = 2 * 1024 * 1024
+ATTACHMENT_PERCEPTUAL_HASH_MAX_PIXELS = 2048 * 2048
+IMAGE_HASH_MAX_DISTANCE = 4
+IMAGE_HASH_MIN_CONTRAST = 16
+ATTACHMENT_DOWNLOAD_TIMEOUT_SECONDS = 10
+ATTACHMENT_CACHE_MAX_ENTRIES = 4096
+EVIDENCE_DOWNLOAD_TIMEOUT_SECONDS = 60
+# Evidence attachments that do not fit in AUTO_BAN_EVIDENCE_MAX_BYTES are saved under data/moderation/evidence/
+# instead (the links to them stop working once the message is deleted), and removed after EVIDENCE_KEEP_DAYS days.
+# So raiders posting big files cannot fill the disk the bot's state is saved on, an attachment is only saved if it
+# is at most EVIDENCE_FILE_MAX_BYTES and the saved evidence stays within EVIDENCE_DISK_MAX_BYTES in total.
+EVIDENCE_KEEP_DAYS = 30
+EVIDENCE_FILE_MAX_BYTES = 25 * 1024 * 1024
+EVIDENCE_DISK_MAX_BYTES = 256 * 1024 * 1024
+
+# Ban actions (roles, reason of ban messages, deletions) are carried out by BAN_WORKER_COUNT workers, off on_message.
+# Requests that fail with an error that may be temporary are tried up to BAN_ACTION_MAX_ATTEMPTS times, waiting
+# BAN_ACTION_RETRY_DELAY_SECONDS (doubling each time) in between.
+BAN_WORKER_COUNT = 2
+BAN_ACTION_MAX_ATTEMPTS = 3
+BAN_ACTION_RETRY_DELAY_SECONDS = 2
+
+# During a raid, the banned role is given to this many members at a time, with a pause between batches
+RAID_RESTRICTION_BATCH_SIZE = 10
+RAID_RESTRICTION_BATCH_INTERVAL_SECONDS = 1
+# Discord messages are limited to 2000 characters
+MESSAGE_CHARACTER_LIMIT = 2000
+
+URL_PATTERN = re.compile(r'https?://[^\s<>]+', re.IGNORECASE)
+URL_TRAILING_PUNCTUATION = '.,;:!?\'")]*_~|'
+# Query parameters that only track where a link was shared from, dropped so copies of a link compare the same.
+# Every other parameter (e.g. the v of a YouTube link or the q of a search) is kept, it is part of what is linked.
+TRACKING_QUERY_PARAMETER_PREFIXES = ('utm_',)
+TRACKING_QUERY_PARAMETERS = frozenset((
+    'fbclid', 'gclid', 'dclid', 'gbraid', 'wbraid', 'msclkid', 'yclid', 'twclid', 'igshid', 'igsh', 'si', 'feature',
+    'mc_cid', 'mc_eid', '_ga', '_gl', 'ref_src', 'ref_url'))
+
+
+def stable_hash(text: str) -> int:
+    """64-bit hash of text that, unlike hash(), is the same across restarts."""
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'big')
+
+
+def normalise_link(url: str) -> str:
+    """
+    Reduce a link to scheme://host/path?query, so copies of the same link shared from different places are compared
+    as the same link. Tracking parameters (see TRACKING_QUERY_PARAMETERS) are dropped and the other parameters sorted.
+    The scheme and host are lowercased, and the fragment, the www. prefix, default ports and trailing slashes
+    dropped. The path and the parameter values keep their case: invite and short link codes are case-sensitive.
+    """
+    url = url.rstrip(URL_TRAILING_PUNCTUATION)
+    try:
+        split_url = urllib.parse.urlsplit(url)
+        host = (split_url.hostname or '').lower()
+        port = split_url.port
+    except ValueError:
+        # malformed link (e.g. invalid port): compare it as written
+        return url
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    scheme = split_url.scheme.lower()
+    if port is not None and (scheme, port) not in (('http', 80), ('https', 443)):
+        host += f':{port}'
+    path = split_url.path.rstrip('/')
+    query = sorted(
+        (name, value) for name, value in urllib.parse.parse_qsl(split_url.query, keep_blank_values=True)
+        if name.lower() not in TRACKING_QUERY_PARAMETERS and not name.lower().startswith(TRACKING_QUERY_PARAMETER_PREFIXES))
+    return f'{scheme}://{host}{path}?{urllib.parse.urlencode(query)}' if query else f'{scheme}://{host}{path}'
+
+
+def extract_links(content: str) -> list:
+    """All distinct links in the message content, normalised, in the order they appear."""
+    if '://' not in content:
+        return []
+    return list(dict.fromkeys(normalise_link(url) for url in URL_PATTERN.findall(content)))
+
+
+async def call_with_retry(function, *args, **kwargs):
+    """
+    Await function(*args, **kwargs), retrying on errors that may be temporary (server errors, dropped connections).
+    Errors that will not go away by retrying (missing permissions, the member or channel being gone) are raised at once.
+    discord.py already waits out rate limits on its own.
+    """
+    delay = BAN_ACTION_RETRY_DELAY_SECONDS
+    for attempt in range(1, BAN_ACTION_MAX_ATTEMPTS + 1):
+        try:
+            return await function(*args, **kwargs)
+        except (discord.errors.Forbidden, discord.errors.NotFound):
+            raise
+        except (discord.errors.HTTPException, aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == BAN_ACTION_MAX_ATTEMPTS:
+                raise
+            await asyncio.sleep(delay)
+            delay *= 2
+
+
+def split_mentions_into_messages(header: str, mentions: list) -> list:
+    """Put the header and the mentions into as few messages as fit in MESSAGE_CHARACTER_LIMIT."""
+    messages = [header]
+    for mention in mentions:
+        if len(messages[-1]) + len(mention) + 1 > MESSAGE_CHARACTER_LIMIT:
+            messages.append('')
+        messages[-1] += mention + ' '
+    return messages
+
+
+def normalise_content(content: str) -> str:
+    """
+    Reduce message content to what near-duplicate matching compares: lowercase letters, digits and single spaces.
+    Emojis, punctuation, markdown and repeated whitespace (what spammers add to make copies differ) are dropped.
+    """
+    return ' '.join(''.join(character if character.isalnum() else ' ' for character in content.casefold()).split())
+
+
+def get_simhash(text: str) -> int:
+    """
+    64-bit SimHash of the text's character shingles: bit i is set when most shingle hashes have bit i set, so texts
+    sharing most shingles get hashes that differ in only a few bits.
+
+    Counting 64 bit positions for every shingle one by one is too slow in Python, so the per-bit counts are kept
+    bit-sliced: counter_planes[j] holds bit j of all 64 counts at once, and adding a shingle hash is a ripple-carry
+    addition over the planes (about two big-int operations per shingle on average).
+    """
+    shingles = {text[i:i + SIMHASH_SHINGLE_LENGTH] for i in range(max(1, len(text) - SIMHASH_SHINGLE_LENGTH + 1))}
+    counter_planes = []
+    for shingle in shingles:
+        carry = stable_hash(shingle)
+        j = 0
+        while carry:
+            if j == len(counter_planes):
+                counter_planes.append(0)
+            counter_planes[j], carry = counter_planes[j] ^ carry, counter_planes[j] & carry
+            j += 1
+    simhash = 0
+    for i in range(64):
+        count = sum(((plane >> i) & 1) << j for j, plane in enumerate(counter_planes))
+        if count * 2 > len(shingles):
+            simhash |= 1 << i
+    return simhash
+
+
+class SimHashIndex:
+    """
+    Locality-sensitive index of SimHashes, to find a near-duplicate (at most max_distance differing bits) of a message
+    without comparing against every message.
+
+    The 64 bits are split into max_distance + 1 bands. Two hashes differing in at most max_distance bits must agree
+    on at least one whole band, so only the hashes sharing a band bucket with the query are ever compared.
+    Each stored hash maps to the content key of the message it came from, counted so the same hash can be added
+    more than once and removed again as messages expire.
+    """
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        self.band_count = max_distance + 1
+        self.band_bits = 64 // self.band_count
+        self.band_mask = (1 << self.band_bits) - 1
+        # simhash -> [content key, number of times added]
+        self.entries = {}
+        # (band index, band value) -> set of simhashes
+        self.buckets = {}
+
+    def get_bands(self, simhash: int) -> list:
+        return [(band, (simhash >> (band * self.band_bits)) & self.band_mask) for band in range(self.band_count)]
+
+    def add(self, simhash: int, content_key: int) -> None:
+        entry = self.entries.get(simhash)
+        if entry is not None:
+            entry[1] += 1
+            return
+        self.entries[simhash] = [content_key, 1]
+        for band in self.get_bands(simhash):
+            self.buckets.setdefault(band, set()).add(simhash)
+
+    def remove(self, simhash: int) -> None:
+        entry = self.entries.get(simhash)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del self.entries[simhash]
+        for band in self.get_bands(simhash):
+            bucket = self.buckets[band]
+            bucket.discard(simhash)
+            if not bucket:
+                del self.buckets[band]
+
+    def find(self, simhash: int):
+        """Content key of the closest stored near-duplicate of simhash, or None."""
+        entry = self.entries.get(simhash)
+        if entry is not None:
+            return entry[0]
+        closest_distance = self.max_distance + 1
+        closest_key = None
+        for band in self.get_bands(simhash):
+            for candidate in self.buckets.get(band, ()):
+                distance = bin(candidate ^ simhash).count('1')
+                if distance < closest_distance:
+                    closest_distance = distance
+                    closest_key = self.entries[candidate][0]
+        return closest_key
+
+
+class ExpiringSimHashIndex(SimHashIndex):
+    """SimHashIndex whose hashes are removed ttl_seconds after being added, keeping at most max_entries at once."""
+    def __init__(self, max_distance: int, ttl_seconds: int, max_entries: int):
+        super().__init__(max_distance)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # (time added, simhash), oldest first
+        self.added = deque()
+
+    def add_at(self, simhash: int, content_key: int, now: int) -> None:
+        self.add(simhash, content_key)
+        self.added.append((now, simhash))
+        self.expire(now)
+
+    def expire(self, now: int) -> None:
+        while self.added and (len(self.added) > self.max_entries or now - self.added[0][0] > self.ttl_seconds):
+            self.remove(self.added.popleft()[1])
+
+
+async def stream_download(session: aiohttp.ClientSession, url: str, file, byte_limit: int, timeout_seconds: int) -> bool:
+    """
+    Stream at most byte_limit bytes from the start of url into file, a chunk at a time, so the download is never
+    held in memory as a whole. Return False if the download fails.
+    """
+    if byte_limit <= 0:
+        return True
+    written = 0
+    try:
+        async with session.get(url, headers={'Range': f'bytes=0-{byte_limit - 1}'},
+                               timeout=aiohttp.ClientTimeout(total=timeout_seconds)) as response:
+            if response.status not in (200, 206):
+                return False
+            # the server may ignore the range and send the whole file, stop reading once we have enough
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                chunk = chunk[:byte_limit - written]
+                file.write(chunk)
+                written += len(chunk)
+                if written >= byte_limit:
+                    break
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return False
+    return True
+
+
+def open_evidence_file(evidence_dir: str, message_id: int, attachment: discord.Attachment, reserved_bytes: int):
+    """
+    Open the file an evidence attachment is saved to, evidence_dir/<message id>/<attachment id>_<filename>, first
+    removing the evidence saved more than EVIDENCE_KEEP_DAYS days ago. Return the open file, or None if saving the
+    attachment would go over EVIDENCE_DISK_MAX_BYTES, counting the evidence already saved and reserved_bytes (the
+    attachments being saved right now).
+    Blocking, call through asyncio.to_thread.
+    """
+    os.makedirs(evidence_dir, exist_ok=True)
+    oldest_kept = datetime.datetime.now().timestamp() - EVIDENCE_KEEP_DAYS * 24 * 60 * 60
+    used_bytes = 0
+    for entry in os.scandir(evidence_dir):
+        if not entry.is_dir():
+            continue
+        if entry.stat().st_mtime < oldest_kept:
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            used_bytes += sum(file_entry.stat().st_size for file_entry in os.scandir(entry.path) if file_entry.is_file())
+    if used_bytes + reserved_bytes + attachment.size > EVIDENCE_DISK_MAX_BYTES:
+        return None
+    message_dir = os.path.join(evidence_dir, str(message_id))
+    os.makedirs(message_dir, exist_ok=True)
+    # the filename comes from the user, keep only its last part so it cannot point outside message_dir
+    filename = f'{attachment.id}_{os.path.basename(attachment.filename)}'
+    return open(os.path.join(message_dir, filename), 'wb')
+
+
+def get_image_difference_hash(data: bytes):
+    """
+    64-bit difference hash (dHash) of an image: shrink to 9x8 greyscale and record whether each pixel is brighter
+    than its right neighbour. Re-encoded, resized or recompressed copies of an image get the same hash, or one
+    differing in a few bits.
+    Return None if Pillow is not installed, the data is not an image Pillow can read, the image has more than
+    ATTACHMENT_PERCEPTUAL_HASH_MAX_PIXELS pixels, or it is too flat to hash (see IMAGE_HASH_MIN_CONTRAST).
+    Blocking, call through asyncio.to_thread.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # only the header has been read so far, check the size before decoding anything
+            if image.width * image.height > ATTACHMENT_PERCEPTUAL_HASH_MAX_PIXELS:
+                return None
+            # lets JPEGs be decoded straight to a small greyscale image
+            image.draft('L', (9 * 8, 8 * 8))
+            pixels = list(image.convert('L').resize((9, 8)).getdata())
+    except Exception:
+        return None
+    if max(pixels) - min(pixels) < IMAGE_HASH_MIN_CONTRAST:
+        return None
+    difference_hash = 0
+    for row in range(8):
+        for column in range(8):
+            difference_hash = (difference_hash << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return difference_hash
+
+
+class AttachmentFingerprinter:
+    """
+    Turns attachments into keys messages can be compared by, without downloading whole files.
+
+    An attachment's key is the hash of its size, filename and the first ATTACHMENT_PARTIAL_HASH_BYTES bytes of its
+    content, streamed with a range request. Images up to ATTACHMENT_PERCEPTUAL_HASH_MAX_BYTES are instead keyed by
+    their difference hash when Pillow is installed, so the same image re-uploaded as a different file still matches:
+    an image whose hash is within IMAGE_HASH_MAX_DISTANCE bits of a recent image's (see image_hashes) gets that
+    image's key.
+
+    Keys are kept in an LRU cache by URL (at most ATTACHMENT_CACHE_MAX_ENTRIES), and concurrent requests for the
+    same URL share one download, so the same attachment is never downloaded twice.
+    """
+    def __init__(self):
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.session = None
+        # difference hashes of recent images, kept as long as a key stays in the cache
+        self.image_hashes = ExpiringSimHashIndex(IMAGE_HASH_MAX_DISTANCE, 24 * 60 * 60, ATTACHMENT_CACHE_MAX_ENTRIES)
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get_key(self, attachment: discord.Attachment) -> int:
+        key = self.cache.get(attachment.url)
+        if key is not None:
+            self.cache.move_to_end(attachment.url)
+            return key
+        if attachment.url not in self.pending:
+            self.pending[attachment.url] = asyncio.ensure_future(self.compute_key(attachment))
+        try:
+            key = await asyncio.shield(self.pending[attachment.url])
+        finally:
+            self.pending.pop(attachment.url, None)
+        self.cache[attachment.url] = key
+        while len(self.cache) > ATTACHMENT_CACHE_MAX_ENTRIES:
+            self.cache.popitem(last=False)
+        return key
+
+    async def compute_key(self, attachment: discord.Attachment) -> int:
+        is_image = (attachment.content_type or '').startswith('image/')
+        # Discord sends the dimensions of images, so too big ones are not even downloaded
+        small_enough = (attachment.size <= ATTACHMENT_PERCEPTUAL_HASH_MAX_BYTES
+                        and (attachment.width or 0) * (attachment.height or 0) <= ATTACHMENT_PERCEPTUAL_HASH_MAX_PIXELS)
+        if is_image and Image is not None and small_enough:
+            data = await self.download(attachment.url, attachment.size)
+            if data is not None and len(data) == attachment.size:
+                difference_hash = await asyncio.to_thread(get_image_difference_hash, data)
+                if difference_hash is not None:
+                    return self.get_image_key(difference_hash)
+            partial_data = data[:ATTACHMENT_PARTIAL_HASH_BYTES] if data is not None else None
+        else:
+            partial_data = await self.download(attachment.url, ATTACHMENT_PARTIAL_HASH_BYTES)
+        # if the download failed, size and filename are still a reasonable (if weaker) fingerprint
+        partial_digest = hashlib.blake2b(partial_data, digest_size=16).hexdigest() if partial_data is not None else ''
+        return stable_hash(f'attachment:{attachment.size}:{attachment.filename}:{partial_digest}')
+
+    def get_image_key(self, difference_hash: int) -> int:
+        """The key of the recent image closest to difference_hash, or a new key if there is none close enough."""
+        key = self.image_hashes.find(difference_hash)
+        if key is None:
+            key = stable_hash(f'image:{difference_hash}')
+        self.image_hashes.add_at(difference_hash, key, int(discord.utils.utcnow().timestamp()))
+        return key
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """The HTTP session attachments are downloaded with, also used for ban evidence."""
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    async def download(self, url: str, byte_limit: int):
+        """Download at most byte_limit bytes from the start of url. Return None if the download fails."""
+        data = io.BytesIO()
+        if not await stream_download(self.get_session(), url, data, byte_limit, ATTACHMENT_DOWNLOAD_TIMEOUT_SECONDS):
+            return None
+        return data.getvalue()
+
+
+class MessageFingerprint:
+    """
+    What the auto-ban state remembers about a message, instead of the full discord.Message.
+    A message is compared by its full content, by every link it has (a link will repeat >= times the message
+    includes it), and by every attachment it has (see AttachmentFingerprinter). All are stored as stable hashes,
+    computed once on arrival and reused for counting, ban decisions and deletion. A message with no text is not
+    compared by content (content_hash is None), otherwise every attachment-only message would look the same.
+    The readable text is only needed (and only available) for the message being checked.
+    Messages long enough to be compared by content also get a SimHash, so a near-duplicate of an earlier message can
+    take over that message's content hash (see use_content_hash) and be counted as the same message.
+    The message itself can still be deleted later through channel.get_partial_message(message_id).
+    """
+    __slots__ = ('message_id', 'channel_id', 'created_at', 'content_hash', 'link_hashes', 'attachment_hashes', 'simhash', 'keys')
+
+    def __init__(self, message: discord.Message, links: list, attachment_hashes: tuple, character_length_minimum: int):
+        self.message_id = message.id
+        self.channel_id = message.channel.id
+        self.created_at = int(message.created_at.timestamp())
+        # prefixed so a message that is just a link is not counted twice under the same key
+        self.content_hash = stable_hash('content:' + message.content) if message.content else None
+        self.link_hashes = tuple(stable_hash('link:' + link) for link in links)
+        self.attachment_hashes = attachment_hashes
+        self.simhash = None
+        if len(message.content) >= character_length_minimum:
+            normalised_content = normalise_content(message.content)
+            if normalised_content:
+                self.simhash = get_simhash(normalised_content)
+        self.update_keys()
+
+    def update_keys(self) -> None:
+        self.keys = self.link_hashes + self.attachment_hashes + ((self.content_hash,) if self.content_hash is not None else ())
+
+    def use_content_hash(self, content_hash: int) -> None:
+        """Compare the message by content_hash instead of its own, e.g. the hash of an earlier near-duplicate."""
+        self.content_hash = content_hash
+        self.update_keys()
+
+    def to_record(self) -> list:
+        """The fingerprint as a JSON-serializable list, see AutoBanStateStore."""
+        return [self.message_id, self.channel_id, self.created_at, self.content_hash, list(self.link_hashes),
+                self.simhash, list(self.attachment_hashes)]
+
+    @classmethod
+    def from_record(cls, record: list) -> 'MessageFingerprint':
+        fingerprint = cls.__new__(cls)
+        fingerprint.message_id, fingerprint.channel_id, fingerprint.created_at, fingerprint.content_hash, link_hashes = record[:5]
+        fingerprint.link_hashes = tuple(link_hashes)
+        # records written before near-duplicate matching / attachment fingerprints have no SimHash / attachments
+        fingerprint.simhash = record[5] if len(record) > 5 else None
+        fingerprint.attachment_hashes = tuple(record[6]) if len(record) > 6 else ()
+        fingerprint.update_keys()
+        return fingerprint
+
+
+class AuthorMessageWindow:
+    """
+    Sliding window of one author's qualifying messages in the last detection period.
+
+    Message fingerprints are kept in a deque in the order they arrive.
+    Alongside, key_channel_counts keeps key -> {channel_id: count} up to date as messages enter and leave the window,
+    so both the same channel and the different channel thresholds are answered without scanning any channel list.
+    near_duplicates indexes the SimHashes of the messages in the window, to match near-duplicates of them.
+    """
+    def __init__(self, near_duplicate_max_distance: int):
+        self.messages = deque()
+        self.key_channel_counts = {}
+        self.near_duplicates = SimHashIndex(near_duplicate_max_distance)
+
+    def add(self, fingerprint: MessageFingerprint) -> None:
+        """Add a message fingerprint to the window."""
+        self.messages.append(fingerprint)
+        if fingerprint.simhash is not None:
+            self.near_duplicates.add(fingerprint.simhash, fingerprint.content_hash)
+        for key in fingerprint.keys:
+            channel_counts = self.key_channel_counts.setdefault(key, {})
+            channel_counts[fingerprint.channel_id] = channel_counts.get(fingerprint.channel_id, 0) + 1
+
+    def expire(self, now: int, period_seconds: int) -> None:
+        """Remove messages from over period_seconds ago. Messages arrive in order, so only the left end needs checking."""
+        while self.messages and now - self.messages[0].created_at > period_seconds:
+            fingerprint = self.messages.popleft()
+            if fingerprint.simhash is not None:
+                self.near_duplicates.remove(fingerprint.simhash)
+            for key in fingerprint.keys:
+                channel_counts = self.key_channel_counts[key]
+                channel_counts[fingerprint.channel_id] -= 1
+                if channel_counts[fingerprint.channel_id] == 0:
+                    del channel_counts[fingerprint.channel_id]
+                    if not channel_counts:
+                        del self.key_channel_counts[key]
+
+    def count_in_channel(self, key: int, channel_id: int) -> int:
+        """Number of times key appeared in the channel within the window."""
+        return self.key_channel_counts.get(key, {}).get(channel_id, 0)
+
+    def channel_ids(self, key: int) -> set:
+        """Set of channel ids key appeared in within the window."""
+        return set(self.key_channel_counts.get(key, {}))
+
+    def messages_with_key(self, key: int, channel_id: int = None) -> list:
+        """Fingerprints of all messages in the window compared by key, optionally only the ones in the given channel."""
+        return [fingerprint for fingerprint in self.messages
+                if key in fingerprint.keys and (channel_id is None or fingerprint.channel_id == channel_id)]
+
+
+class CrossUserContentIndex:
+    """
+    Guild-wide index of which authors recently posted each message key (content or link hash), to catch coordinated
+    spam where many accounts each post the same thing only once.
+
+    Memory is bounded: a key is dropped once nobody posted it for ttl_seconds, and at most max_keys keys are kept,
+    the least recently posted dropped first. Keys are kept in an OrderedDict in order of last post, so both only
+    ever look at the front, and adding a key is O(1) amortised.
+    The authors of each key are kept in order of their last post as well, and the ones who have not posted it for
+    ttl_seconds are dropped when the key is added, so right after adding, the number of recent authors of the key
+    (author_count) is O(1).
+    """
+    def __init__(self, ttl_seconds: int, max_keys: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_keys = max_keys
+        # key -> (last posted, OrderedDict of author_id -> last posted by author, oldest first)
+        self.entries = OrderedDict()
+
+    def add(self, key: int, author_id: int, now: int) -> None:
+        entry = self.entries.pop(key, None)
+        authors = entry[1] if entry is not None else OrderedDict()
+        authors.pop(author_id, None)
+        authors[author_id] = now
+        while now - next(iter(authors.values())) > self.ttl_seconds:
+            authors.popitem(last=False)
+        self.entries[key] = (now, authors)
+        self.expire(now)
+
+    def author_count(self, key: int) -> int:
+        """The number of authors who posted key in the last ttl_seconds, as of its last add."""
+        entry = self.entries.get(key)
+        return len(entry[1]) if entry is not None else 0
+
+    def expire(self, now: int) -> None:
+        while self.entries:
+            last_posted, _ = next(iter(self.entries.values()))
+            if len(self.entries) <= self.max_keys and now - last_posted <= self.ttl_seconds:
+                break
+            self.entries.popitem(last=False)
+
+    def recent_authors(self, key: int, now: int) -> list:
+        """Ids of the authors who posted key in the last ttl_seconds."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return []
+        return [author_id for author_id, last_posted in entry[1].items() if now - last_posted <= self.ttl_seconds]
+
+
+class JoinRateMonitor:
+    """
+    Rolling histogram of member joins over the last window_seconds seconds, one bucket per second.
+    Each bucket keeps the ids of the members who joined in that second, so the whole burst can be acted on at once.
+    """
+    def __init__(self, window_seconds: int):
+        self.window_seconds = window_seconds
+        self.buckets = deque()
+        self.count = 0
+
+    def add(self, now: int, member_id: int) -> None:
+        """Record a join at now (seconds), and drop joins that left the window."""
+        if self.buckets and self.buckets[-1][0] == now:
+            self.buckets[-1][1].append(member_id)
+        else:
+            self.buckets.append((now, [member_id]))
+        self.count += 1
+        self.expire(now)
+
+    def expire(self, now: int) -> None:
+        while self.buckets and now - self.buckets[0][0] >= self.window_seconds:
+            self.count -= len(self.buckets.popleft()[1])
+
+    def member_ids(self) -> list:
+        """Ids of the members who joined within the window, oldest first."""
+        return [member_id for _, bucket_member_ids in self.buckets for member_id in bucket_member_ids]
+
+
+class AutoBanStateStore:
+    """
+    Keeps the auto-ban state (users being banned, and every author's message window) on disk, so a restart in the
+    middle of a raid picks up where it left off.
+
+    Every change is appended to a journal as one JSON line:
+        {"op": "ban", "user_id": <USER_ID>, "timestamp": <UNIX TIMESTAMP>, "generation": <GENERATION>}
+        {"op": "unban", "user_id": <USER_ID>, "generation": <GENERATION>}
+        {"op": "message", "user_id": <USER_ID>, "fingerprint": [<MESSAGE_ID>, <CHANNEL_ID>, <CREATED_AT>, <CONTENT_HASH>, [<LINK_HASH>, ...], <SIMHASH>, [<ATTACHMENT_HASH>, ...]], "generation": <GENERATION>}
+        {"op": "forget", "user_id": <USER_ID>, "generation": <GENERATION>}
+    Periodically the whole state is written to a snapshot and the journal is emptied. On startup the snapshot is
+    loaded and the journal replayed on top of it.
+
+    Files are only ever written by the writer (see QueuedFileWriter). Journal entries and snapshots go through the same
+    queue, so a snapshot always covers exactly the entries queued before it, and it is safe to empty the journal right
+    after writing it.
+    Every snapshot starts a new generation, and journal entries carry the generation they were recorded in. If the
+    journal could not be emptied after a snapshot (the bot died in between, or the disk failed), the entries of older
+    generations are skipped on load, as the snapshot already holds them: replaying a message twice would count it
+    twice towards a ban.
+    """
+    def __init__(self, directory: str):
+        self.journal_path = os.path.join(directory, 'auto_ban_journal.jsonl')
+        self.snapshot_path = os.path.join(directory, 'auto_ban_snapshot.json')
+        self.writer = QueuedFileWriter(self.write_items, 'auto-ban state')
+        # the generation of the latest snapshot, set from the loaded state before the writer starts
+        self.generation = 0
+
+    def load(self) -> dict:
+        """Read the snapshot and replay the journal. Blocking, call through asyncio.to_thread."""
+        state = {'banned_users_ids': set(), 'banned_users_timestamps': {}, 'windows': {}, 'generation': 0}
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as file:
+                snapshot = json.load(file)
+            # snapshots and entries from before generations were kept count as generation 0
+            state['generation'] = snapshot.get('generation', 0)
+            state['banned_users_ids'] = set(snapshot['banned_users_ids'])
+            state['banned_users_timestamps'] = {int(user_id): timestamp for user_id, timestamp in snapshot['banned_users_timestamps'].items()}
+            state['windows'] = {int(user_id): records for user_id, records in snapshot['windows'].items()}
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path, 'r') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line may be cut short if the bot died while writing it
+                        continue
+                    if entry.get('generation', 0) >= state['generation']:
+                        self.apply_journal_entry(state, entry)
+        return state
+
+    @staticmethod
+    def apply_journal_entry(state: dict, entry: dict) -> None:
+        user_id = entry['user_id']
+        if entry['op'] == 'ban':
+            state['banned_users_ids'].add(user_id)
+            state['banned_users_timestamps'][user_id] = entry['timestamp']
+        elif entry['op'] == 'unban':
+            state['banned_users_ids'].discard(user_id)
+        elif entry['op'] == 'message':
+            state['windows'].setdefault(user_id, []).append(entry['fingerprint'])
+        elif entry['op'] == 'forget':
+            state['windows'].pop(user_id, None)
+
+    def record(self, entry: dict) -> None:
+        """Queue a journal entry. Never blocks."""
+        self.writer.put('journal', json.dumps(dict(entry, generation=self.generation), separators=(',', ':')))
+
+    def request_snapshot(self, state: dict) -> None:
+        """Queue a snapshot of state (already converted to plain JSON types), starting a new generation. Never blocks."""
+        self.generation += 1
+        self.writer.put('snapshot', json.dumps(dict(state, generation=self.generation), separators=(',', ':')))
+
+    def write_items(self, items: list) -> None:
+        journal_lines = []
+        for kind, data in items:
+            if kind == 'journal':
+                journal_lines.append(data)
+            elif kind == 'snapshot':
+                # everything in the journal so far is covered by the snapshot
+                journal_lines = []
+                write_file_atomically(self.snapshot_path, data)
+                open(self.journal_path, 'w').close()
+        if journal_lines:
+            append_to_file(self.journal_path, '\n'.join(journal_lines) + '\n')
 
 
 class AutoBanningCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
+        config = bot.config
         self.bot = bot
         self.guild = None
         self.user_messages_dict = {}
-        self.banned_users_id_list = []
+        self.banned_users_id_set = set()
         self.banned_users_timestamp_dict = {}
+        self.member_classes = {}
+        curr_dir = os.path.abspath(os.path.dirname(__file__))
+        self.moderation_dir = os.path.join(curr_dir, '..', '..', 'data', 'moderation')
+        self.state_store = AutoBanStateStore(self.moderation_dir)
+        self.evidence_dir = os.path.join(self.moderation_dir, 'evidence')
+        # bytes of the evidence attachments being saved right now, see save_evidence_attachment
+        self.evidence_bytes_being_saved = 0
+        self.cross_user_content_index = CrossUserContentIndex(config.auto_ban_detection_period_minutes * 60, CROSS_USER_INDEX_MAX_KEYS)
+        self.attachment_fingerprinter = AttachmentFingerprinter()
+        self.near_duplicate_index = ExpiringSimHashIndex(
+            config.auto_ban_near_duplicate_max_distance, config.auto_ban_detection_period_minutes * 60, NEAR_DUPLICATE_INDEX_MAX_ENTRIES)
+        self.join_rate_monitor = JoinRateMonitor(config.auto_ban_raid_join_window_seconds)
+        self.raid_mode = False
+        self.raid_restriction_queue = deque()
+        self.raid_restriction_task = None
+        self.background_tasks = set()
+        self.ban_queue = asyncio.Queue()
+        self.ban_workers = []
+        self.sweep_idle_authors.change_interval(minutes=config.auto_ban_detection_period_minutes)
 
     @commands.Cog.listener()
     async def on_ready(self):
-        self.guild = self.bot.get_guild(SERVER_ID)
-        self.user_messages_dict = {}
-        self.banned_users_id_list = []
-        self.banned_users_timestamp_dict = {}
+        """
+        On the first ready, restore the state saved before the last restart (see AutoBanStateStore).
+        on_ready also fires after reconnecting, when the state in memory is already up to date and is kept.
+        """
+        self.guild = self.bot.get_guild(self.bot.config.server_id)
+        first_ready = not self.state_store.writer.is_started()
+        if first_ready:
+            state = await asyncio.to_thread(self.state_store.load)
+            self.state_store.generation = state['generation']
+            self.load_state(state)
+            self.state_store.writer.start()
+        self.member_classes = {}
+        for member in self.guild.members:
+            self.update_member_class(member)
+        if first_ready:
+            await self.finish_interrupted_bans()
+        if not self.sweep_idle_authors.is_running():
+            self.sweep_idle_authors.start()
+        if not self.ban_workers:
+            self.ban_workers = [asyncio.create_task(self.run_ban_worker()) for _ in range(BAN_WORKER_COUNT)]
         await self.bot.log(
             cog=self,
             user=None,
@@ -39,12 +763,225 @@ class AutoBanningCog(commands.Cog):
             event='AutoBanningCog is ready.',
             outcome=None)
 
+    async def cog_unload(self) -> None:
+        self.sweep_idle_authors.cancel()
+        for task in self.background_tasks:
+            task.cancel()
+        for worker in self.ban_workers:
+            worker.cancel()
+        if not self.ban_queue.empty():
+            await self.bot.log(
+                cog=self,
+                user=None,
+                user_action=None,
+                channel=None,
+                event=f'Unloading with {self.ban_queue.qsize()} ban action(s) still queued, they are dropped.',
+                outcome='The banned role is given again after the restart (see finish_interrupted_bans), but their '
+                        'messages are not deleted and no reason of ban message is sent.')
+        await self.attachment_fingerprinter.close()
+        if self.raid_restriction_task is not None:
+            self.raid_restriction_task.cancel()
+        if self.state_store.writer.is_started():
+            self.state_store.request_snapshot(self.get_state())
+            await self.state_store.writer.close()
+
+    @commands.Cog.listener()
+    async def on_config_reload(self, before: Config, after: Config) -> None:
+        """
+        Everything read through bot.config picks up a reload by itself. Apply the settings that were copied into
+        the sweep loop and the guild-wide indexes when the cog was loaded.
+        """
+        if after.auto_ban_detection_period_minutes != before.auto_ban_detection_period_minutes:
+            self.sweep_idle_authors.change_interval(minutes=after.auto_ban_detection_period_minutes)
+            self.cross_user_content_index.ttl_seconds = after.auto_ban_detection_period_minutes * 60
+            self.near_duplicate_index.ttl_seconds = after.auto_ban_detection_period_minutes * 60
+        self.join_rate_monitor.window_seconds = after.auto_ban_raid_join_window_seconds
+        if after.auto_ban_raid_join_threshold == 0 and self.raid_mode:
+            await self.end_raid_mode('Raid detection was turned off (AUTO_BAN_RAID_JOIN_THRESHOLD is 0).')
+        if after.auto_ban_near_duplicate_max_distance != before.auto_ban_near_duplicate_max_distance:
+            # the band layout depends on the distance, so the indexes are rebuilt from the hashes they hold
+            near_duplicate_index = ExpiringSimHashIndex(
+                after.auto_ban_near_duplicate_max_distance, self.near_duplicate_index.ttl_seconds, NEAR_DUPLICATE_INDEX_MAX_ENTRIES)
+            for added_at, simhash in self.near_duplicate_index.added:
+                near_duplicate_index.add_at(simhash, self.near_duplicate_index.entries[simhash][0], added_at)
+            self.near_duplicate_index = near_duplicate_index
+            for user_window in self.user_messages_dict.values():
+                user_window.near_duplicates = SimHashIndex(after.auto_ban_near_duplicate_max_distance)
+                for fingerprint in user_window.messages:
+                    if fingerprint.simhash is not None:
+                        user_window.near_duplicates.add(fingerprint.simhash, fingerprint.content_hash)
+        if after.banned_role_id != before.banned_role_id and self.guild is not None:
+            self.member_classes = {}
+            for member in self.guild.members:
+                self.update_member_class(member)
+
+    async def finish_interrupted_bans(self) -> None:
+        """
+        A ban whose timestamp is still in the future was never confirmed: the bot restarted between deciding to ban
+        and the banned role being given. Give the role now, if the user is still here and does not have it yet.
+        """
+        config = self.bot.config
+        now = discord.utils.utcnow()
+        for author_id in list(self.banned_users_id_set):
+            if self.banned_users_timestamp_dict.get(author_id, now) <= now:
+                continue
+            member = self.guild.get_member(author_id)
+            if member is None or member.get_role(config.banned_role_id) is not None:
+                continue
+            try:
+                await member.add_roles(discord.Object(id=config.banned_role_id))
+                outcome = 'Banned'
+            except discord.errors.HTTPException as e:
+                outcome = f'Failed to give banned role: {e}'
+            await self.bot.log(
+                cog=self,
+                user=member,
+                user_action=None,
+                channel=None,
+                event=f'User {member.mention} was being banned when the bot restarted.',
+                outcome=outcome)
+
+    def get_state(self) -> dict:
+        """The auto-ban state in plain JSON types, for AutoBanStateStore snapshots."""
+        return {
+            'banned_users_ids': list(self.banned_users_id_set),
+            'banned_users_timestamps': {str(user_id): timestamp.timestamp() for user_id, timestamp in self.banned_users_timestamp_dict.items()},
+            'windows': {str(user_id): [fingerprint.to_record() for fingerprint in user_window.messages] for user_id, user_window in self.user_messages_dict.items()}}
+
+    def index_fingerprint(self, author_id: int, fingerprint: MessageFingerprint, recent_joiner: bool) -> None:
+        """
+        Add the message to the guild-wide indexes.
+        Only messages of recent joiners (see is_recent_joiner) go in the cross-user index, as only they count
+        towards coordinated spam. Content only goes in when it is long enough to get a SimHash (at least
+        AUTO_BAN_CHARACTER_LENGTH_MINIMUM characters): many people replying "same" or "thanks!" is not spam.
+        """
+        if recent_joiner:
+            for key in fingerprint.link_hashes + fingerprint.attachment_hashes:
+                self.cross_user_content_index.add(key, author_id, fingerprint.created_at)
+        if fingerprint.simhash is not None:
+            if recent_joiner:
+                self.cross_user_content_index.add(fingerprint.content_hash, author_id, fingerprint.created_at)
+            self.near_duplicate_index.add_at(fingerprint.simhash, fingerprint.content_hash, fingerprint.created_at)
+
+    def load_state(self, state: dict) -> None:
+        """
+        Restore the state read by AutoBanStateStore.load, dropping messages that expired while the bot was down.
+        The guild-wide indexes are rebuilt from the restored messages.
+        """
+        config = self.bot.config
+        now = int(discord.utils.utcnow().timestamp())
+        self.banned_users_id_set = state['banned_users_ids']
+        self.banned_users_timestamp_dict = {
+            user_id: datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+            for user_id, timestamp in state['banned_users_timestamps'].items()}
+        self.user_messages_dict = {}
+        restored_fingerprints = []
+        for user_id, records in state['windows'].items():
+            user_window = AuthorMessageWindow(config.auto_ban_near_duplicate_max_distance)
+            for record in records:
+                user_window.add(MessageFingerprint.from_record(record))
+            user_window.expire(now, config.auto_ban_detection_period_minutes * 60)
+            if user_window.messages:
+                self.user_messages_dict[user_id] = user_window
+                restored_fingerprints += [(fingerprint.created_at, user_id, fingerprint) for fingerprint in user_window.messages]
+        recent_joiner_ids = {user_id for user_id in self.user_messages_dict if self.is_recent_joiner(user_id)}
+        # the indexes expect messages in the order they were sent
+        for _, user_id, fingerprint in sorted(restored_fingerprints, key=lambda x: x[0]):
+            self.index_fingerprint(user_id, fingerprint, user_id in recent_joiner_ids)
+
+    # the interval is set to the detection period in __init__ and on_config_reload
+    @tasks.loop(minutes=1)
+    async def sweep_idle_authors(self) -> None:
+        """
+        on_message only expires the window of the author who just sent a message, so an author who posts once and
+        never again would keep their window forever. Every detection period, expire every window against the current
+        time and evict the authors left with nothing in it.
+        Users banned over a day ago are dropped from the banned list as well: by then they hold the banned role, which
+        on_message ignores anyway.
+        """
+        config = self.bot.config
+        now = discord.utils.utcnow()
+        # list() since entries are deleted while iterating
+        for author_id, user_window in list(self.user_messages_dict.items()):
+            user_window.expire(int(now.timestamp()), config.auto_ban_detection_period_minutes * 60)
+            if not user_window.messages:
+                del self.user_messages_dict[author_id]
+        for author_id, timestamp in list(self.banned_users_timestamp_dict.items()):
+            if now - timestamp > datetime.timedelta(days=1):
+                del self.banned_users_timestamp_dict[author_id]
+                if author_id in self.banned_users_id_set:
+                    self.banned_users_id_set.remove(author_id)
+                    self.state_store.record({'op': 'unban', 'user_id': author_id})
+                    member = self.guild.get_member(author_id)
+                    if member is not None:
+                        self.update_member_class(member)
+                    else:
+                        self.member_classes.pop(author_id, None)
+        # end raid mode if joins stopped altogether, otherwise this only happens on the next join
+        self.join_rate_monitor.expire(int(now.timestamp()))
+        if self.raid_mode and self.join_rate_monitor.count < config.auto_ban_raid_join_threshold:
+            await self.end_raid_mode()
+        # compact the journal: the snapshot also drops everything just swept
+        self.state_store.request_snapshot(self.get_state())
+
+    def classify_member(self, member: discord.Member) -> str:
+        """Work out how on_message should treat the member's messages from their roles."""
+        config = self.bot.config
+        if member.id in self.banned_users_id_set:
+            return MEMBER_BANNED_PENDING
+        role_ids = {role.id for role in member.roles}
+        if config.banned_role_id in role_ids or not config.administration_roles_ids.isdisjoint(role_ids):
+            return MEMBER_EXEMPT
+        return MEMBER_NORMAL
+
+    def update_member_class(self, member: discord.Member) -> None:
+        """Refresh the member's entry in the classification cache. Only non-normal members are stored."""
+        member_class = self.classify_member(member)
+        if member_class == MEMBER_NORMAL:
+            self.member_classes.pop(member.id, None)
+        else:
+            self.member_classes[member.id] = member_class
+
+    def mark_banned(self, author_id: int) -> None:
+        """Start banning a user: delete everything they send until the banned role is confirmed."""
+        self.banned_users_id_set.add(author_id)
+        self.member_classes[author_id] = MEMBER_BANNED_PENDING
+        # timestamp of 1 day later - stop deleting user's messages after 1 day
+        self.set_banned_timestamp(author_id, discord.utils.utcnow() + datetime.timedelta(days=1))
+
+    def set_banned_timestamp(self, author_id: int, timestamp: datetime.datetime) -> None:
+        """Messages the banned user sent before timestamp are deleted."""
+        self.banned_users_timestamp_dict[author_id] = timestamp
+        self.state_store.record({'op': 'ban', 'user_id': author_id, 'timestamp': timestamp.timestamp()})
+
+    def forget_messages(self, author_id: int) -> None:
+        """Delete record of the user's messages."""
+        if self.user_messages_dict.pop(author_id, None) is not None:
+            self.state_store.record({'op': 'forget', 'user_id': author_id})
+
+    async def delete_message_from_banned_user(self, message: discord.Message) -> None:
+        """Delete a message the user sent after we started banning them, but before the banned role was confirmed."""
+        author_id = message.author.id
+        # check if message is sent before the timestamp
+        if (message.created_at < self.banned_users_timestamp_dict[author_id]) if author_id in self.banned_users_timestamp_dict else True:
+            # delete message
+            await message.delete()
+            # log
+            await self.bot.log(
+                cog=self,
+                user=message.author,
+                user_action='sent a message',
+                channel=message.channel,
+                event='user sent another message when user just got banned, but not yet receiving the banned role',
+                outcome='deleted the message')
+
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
         """
         Whenever a user sends a message, check if they have sent:
             - repeating messages in repeat_message_in_different_channel_threshold or more channels in the last time_threshold_minutes minutes
             - repeating messages in same channel for repeat_message_in_same_channel_threshold or more times in the last time_threshold_minutes minutes
+            - repeating messages that AUTO_BAN_NUMBER_OF_DISTINCT_AUTHORS_REPEAT or more different users who joined in the last AUTO_BAN_CLUSTER_MEMBER_MAX_AGE_DAYS days sent in the last time_threshold_minutes minutes (all of them are banned)
         Here repeating message:
             - any message that has same content, and is >= character_length_minimum_threshold characters long
             - any message that has same attachment
@@ -53,16 +990,27 @@ class AutoBanningCog(commands.Cog):
         It was tricky to figure out async with this, but essentially we update internal variables before any await.
         If a message was sent between the time we initiate giving @banned and the time actually receive @banned,
             we always delete the message.
+        on_message only decides on bans. Everything a ban involves that talks to Discord (giving @banned, the log,
+            the reason of ban message, deleting the messages) is queued for the ban workers, so checking messages
+            never waits on it. A user is only ever queued once: they are marked as banned before on_message returns.
         Also, we ban users who send message with link or attachment within new_user_ban_threshold_seconds seconds of joining the server. (likely bots)
         """
-        repeat_message_in_same_channel_threshold = AUTO_BAN_NUMBER_OF_REPEAT_IN_SAME_CHANNEL
-        repeat_message_in_different_channel_threshold = AUTO_BAN_NUMBER_OF_DIFFERENT_CHANNEL_REPEAT
-        character_length_minimum_threshold = AUTO_BAN_CHARACTER_LENGTH_MINIMUM
-        time_threshold_minutes = AUTO_BAN_DETECTION_PERIOD_MINUTES
-        new_user_ban_threshold_seconds = AUTO_BAN_NEW_USER_THRESHOLD_SECONDS
+        config = self.bot.config
+        repeat_message_in_same_channel_threshold = config.auto_ban_number_of_repeat_in_same_channel
+        repeat_message_in_different_channel_threshold = config.auto_ban_number_of_different_channel_repeat
+        character_length_minimum_threshold = config.auto_ban_character_length_minimum
+        time_threshold_minutes = config.auto_ban_detection_period_minutes
+        new_user_ban_threshold_seconds = config.auto_ban_new_user_threshold_seconds
 
         author_id = message.author.id
 
+        # ignore messages sent by users with administration roles, and completely ignore messages sent by users with
+        # banned role but not in banned_users_id_set. The classification cache is kept up to date by the member events,
+        # so this is a single lookup.
+        member_class = self.member_classes.get(author_id, MEMBER_NORMAL)
+        if member_class == MEMBER_EXEMPT:
+            return
+
         # ignore messages sent by the bot
         if message.author == self.bot.user:
             return
@@ -71,232 +1019,451 @@ class AutoBanningCog(commands.Cog):
         if not isinstance(message.author, discord.Member):
             return
 
-        if self.guild.get_member(author_id).roles:
-            for role in self.guild.get_member(author_id).roles:
-                # ignore messages sent by users with administration roles
-                if role.id in ADMINISTRATION_ROLES_IDS:
-                    return
-                # completely ignore messages sent by users with banned role but not in banned_users_id_list
-                if role.id == BANNED_ROLE_ID and author_id not in self.banned_users_id_list:
-                    return
-
-        # check if user is in banned_users_id_list
-        if author_id in self.banned_users_id_list:
-            # check if message is sent before the timestamp
-            if (message.created_at < self.banned_users_timestamp_dict[author_id]) if author_id in self.banned_users_timestamp_dict else True:
-                # delete message
-                await message.delete()
-                # log
-                await self.bot.log(
-                    cog=self,
-                    user=message.author,
-                    user_action='sent a message',
-                    channel=message.channel,
-                    event='user sent another message when user just got banned, but not yet receiving the banned role',
-                    outcome='deleted the message')
-                return
-            else:
-                return
+        # check if user is in banned_users_id_set
+        if member_class == MEMBER_BANNED_PENDING:
+            await self.delete_message_from_banned_user(message)
+            return
+
+        # extract the links once, everything below reuses them
+        links = extract_links(message.content)
 
         # check if the message fulfills the criteria of repeating message
-        if not (len(message.content) >= character_length_minimum_threshold or message.attachments or 'http' in message.content):
+        if not (len(message.content) >= character_length_minimum_threshold or message.attachments or links):
             # No need to check if the message is not a repeating message
             return
 
         # Perform the check for new member sending attachment / link
-        if message.attachments or 'http' in message.content:
+        if message.attachments or links:
             # if member joined less than 1 minute ago, ban them
             if (discord.utils.utcnow() - message.author.joined_at).total_seconds() < new_user_ban_threshold_seconds:
-                self.banned_users_id_list.append(author_id)
-                # timestamp of 1 day later - stop deleting user's messages after 1 day
-                self.banned_users_timestamp_dict[author_id] = discord.utils.utcnow() + datetime.timedelta(days=1)
-                # give user banned role
-                await self.guild.get_member(author_id).add_roles(discord.Object(id=BANNED_ROLE_ID))
-                # log
-                await self.bot.log(
-                    cog=self,
-                    user=self.guild.get_member(author_id),
-                    user_action=None,
-                    channel=message.channel,
-                    event=f'User {self.guild.get_member(author_id).mention} joined less than {new_user_ban_threshold_seconds} seconds ago, and sent a the message: {message.content} with attachment or link',
-                    outcome='Banned')
-                # tell user they are banned
-                reason_of_ban_channel = self.guild.get_channel(REASON_OF_BAN_CHANNEL_ID)
-                # Load all attachments to files so they can be sent
-                attachments = [await attachment.to_file() for attachment in message.attachments]
-                await reason_of_ban_channel.send(
-                    f'{self.guild.get_member(author_id).mention}\nReason -- sending suspicious message:\n{message.content}\nwith attachment or link within {new_user_ban_threshold_seconds} seconds of joining the server.', files=attachments)
-                # set the timestamp to right now - as we are now sure the user is properly banned
-                self.banned_users_timestamp_dict[author_id] = discord.utils.utcnow()
-                await message.delete()
-                await self.bot.log(
-                    cog=self,
-                    user=message.author,
-                    user_action='sent a message',
-                    channel=message.channel,
-                    event=f'user sent a message with attachment or link within {new_user_ban_threshold_seconds} seconds of joining the server',
-                    outcome='deleted the message')
+                self.mark_banned(author_id)
+                self.queue_ban_action(self.ban_new_user, message)
                 return
 
-        # Due to a recent accidental ban (someone sent different images, but got flagged as "spam" because there are
-        #   no content in the image message, so the system thought they were "same" message)
-        # Also, we don't need to ban people for sending a lot of attachments since this is a slow way of spamming.
-        # This block is placed after the new user check so that new users can still be banned for sending attachments
-        if message.attachments and not message.content:
-            # don't care about attachments with NO text
-            return
+        # Attachments used to be ignored when the message had no text, after an accidental ban (someone sent different
+        #   images, but got flagged as "spam" because there are no content in the image message, so the system thought
+        #   they were "same" message). Attachments are now compared by their own fingerprints, and a message with no
+        #   text is not compared by its (empty) content at all, so different images no longer look the same.
+        # attachment filenames stand in for the readable text of the attachment keys in the log and ban reason
+        attachment_key_texts = {}
+        if message.attachments:
+            attachment_keys = await asyncio.gather(
+                *[self.attachment_fingerprinter.get_key(attachment) for attachment in message.attachments])
+            for attachment, attachment_key in zip(message.attachments, attachment_keys):
+                attachment_key_texts.setdefault(attachment_key, f'attachment {attachment.filename}')
+            # another message from the author may have got them banned while the attachments were fingerprinted.
+            # There is no await from here until the ban decision, so this is the last chance for that to happen.
+            if author_id in self.banned_users_id_set:
+                await self.delete_message_from_banned_user(message)
+                return
 
-        # load the message
-        if author_id in self.user_messages_dict:
-            self.user_messages_dict[author_id].append(message)
-        else:
-            self.user_messages_dict[author_id] = [message]
-        for message_in_list in self.user_messages_dict[author_id]:
-            # Remove messages from over time_threshold_minutes minutes ago. Assume the message is already sorted by time
-            if message.created_at - message_in_list.created_at > datetime.timedelta(minutes=time_threshold_minutes):
-                self.user_messages_dict[author_id].remove(message_in_list)
+        # load the message into the author's window, and drop messages from over time_threshold_minutes minutes ago
+        if author_id not in self.user_messages_dict:
+            self.user_messages_dict[author_id] = AuthorMessageWindow(config.auto_ban_near_duplicate_max_distance)
+        user_window = self.user_messages_dict[author_id]
+        fingerprint = MessageFingerprint(
+            message, links, tuple(attachment_key_texts), config.auto_ban_character_length_minimum)
+        # a near-duplicate of a recent message (the author's own first, then anyone's) counts as that same message
+        if fingerprint.simhash is not None:
+            near_duplicate_content_hash = user_window.near_duplicates.find(fingerprint.simhash)
+            if near_duplicate_content_hash is None:
+                near_duplicate_content_hash = self.near_duplicate_index.find(fingerprint.simhash)
+            if near_duplicate_content_hash is not None:
+                fingerprint.use_content_hash(near_duplicate_content_hash)
+        recent_joiner = self.is_recent_joiner(author_id)
+        self.index_fingerprint(author_id, fingerprint, recent_joiner)
+        user_window.add(fingerprint)
+        self.state_store.record({'op': 'message', 'user_id': author_id, 'fingerprint': fingerprint.to_record()})
+        user_window.expire(fingerprint.created_at, time_threshold_minutes * 60)
+
+        # Only the keys of this message can have reached a threshold: any earlier hit would have banned the user already.
+        # The window only has hashes, so map them back to readable text from this message for the log and ban reason.
+        # Sort by length of message to make sure the longest message is banned and deleted first
+        message_key_texts = dict(zip(fingerprint.link_hashes, links))
+        message_key_texts.update(attachment_key_texts)
+        if fingerprint.content_hash is not None:
+            message_key_texts[fingerprint.content_hash] = message.content
+        message_keys = sorted(message_key_texts, key=lambda x: len(message_key_texts[x]), reverse=True)
 
         # check if user has sent repeating messages in same channel for n or more times in the last m minutes
-        # also track number of channels each message appears in
-        message_channel_repeats_dict = {}
-        for channel in self.guild.text_channels:
-            counts_dict = {}
-            for message_in_list in self.user_messages_dict[author_id]:
-                # if message has link, only count the link, cuz link will repeat >= times the message includes it
-                if 'http://' in message_in_list.content or 'https://' in message_in_list.content:
-                    for chunk in message_in_list.content.split():
-                        if 'http://' in chunk or 'https://' in chunk:
-                            if chunk in message_channel_repeats_dict:
-                                message_channel_repeats_dict[chunk].add(message_in_list.channel.id)
-                            else:
-                                message_channel_repeats_dict[chunk] = {message_in_list.channel.id}
-                            if message_in_list.channel == channel:
-                                counts_dict[chunk] = counts_dict.get(chunk, 0) + 1
-                # Recent change: record the message itself even if there's link. Since we might want the full context
-                if message_in_list.content in message_channel_repeats_dict:
-                    message_channel_repeats_dict[message_in_list.content].add(message_in_list.channel.id)
-                else:
-                    message_channel_repeats_dict[message_in_list.content] = {message_in_list.channel.id}
-                if message_in_list.channel == channel:
-                    counts_dict[message_in_list.content] = counts_dict.get(message_in_list.content, 0) + 1
-
-            # check if condition is met. Do this sorted thing to make sure the longest message is deleted first
-            for message_content in sorted(counts_dict, key=lambda x: len(x), reverse=True):
-                message_count = counts_dict[message_content]
-                if message_count >= repeat_message_in_same_channel_threshold:
-                    self.banned_users_id_list.append(author_id)
-                    # timestamp of 1 day later - stop deleting user's messages after 1 day
-                    self.banned_users_timestamp_dict[author_id] = discord.utils.utcnow() + datetime.timedelta(days=1)
-                    # give user banned role
-                    await self.guild.get_member(author_id).add_roles(discord.Object(id=BANNED_ROLE_ID))
-                    # log
-                    await self.bot.log(
-                        cog=self,
-                        user=self.guild.get_member(author_id),
-                        user_action=None,
-                        channel=channel,
-                        event=f'User {self.guild.get_member(author_id).mention} sent repeating message {message_content} {message_count} times in last {time_threshold_minutes} minutes in the same channel.',
-                        outcome='Banned')
-                    # tell user they are banned
-                    reason_of_ban_channel = self.guild.get_channel(REASON_OF_BAN_CHANNEL_ID)
-                    await reason_of_ban_channel.send(
-                        f'{self.guild.get_member(author_id).mention}\nReason -- sending repeating message:\n{message_content}\nmultiple times in the same channel.')
-                    # set the timestamp to right now - as we are now sure the user is properly banned
-                    self.banned_users_timestamp_dict[author_id] = discord.utils.utcnow()
-
-                    # delete the banned messages
-                    for message_in_list in self.user_messages_dict[author_id]:
-                        if message_in_list.channel == channel:
-                            if 'http://' in message_in_list.content or 'https://' in message_in_list.content:
-                                for chunk in message_in_list.content.split():
-                                    if 'http://' in chunk or 'https://' in chunk:
-                                        if chunk == message_content:
-                                            try:
-                                                await message_in_list.delete()
-                                            except discord.errors.NotFound:
-                                                pass
-                            else:
-                                # For this, it's not necessary to make additional checks. since full message is subset
-                                # of message with this link
-                                if message_in_list.content == message_content:
-                                    try:
-                                        await message_in_list.delete()
-                                    except discord.errors.NotFound:
-                                        pass
-
-                    await self.bot.log(
-                        cog=self,
-                        user=self.guild.get_member(author_id),
-                        user_action=None,
-                        channel=channel,
-                        event=f'Deleted repeating message {message_content} {message_count} times in last {time_threshold_minutes} minutes in the same channel.',
-                        outcome=None)
-                    # delete record of the banned messages
-                    del self.user_messages_dict[author_id]
-                    return
+        for message_key in message_keys:
+            message_content = message_key_texts[message_key]
+            message_count = user_window.count_in_channel(message_key, message.channel.id)
+            if message_count >= repeat_message_in_same_channel_threshold:
+                self.mark_banned(author_id)
+                fingerprints = user_window.messages_with_key(message_key, message.channel.id)
+                # delete record of the banned messages
+                self.forget_messages(author_id)
+                self.queue_ban_action(
+                    self.ban_user, message.author, message.channel, fingerprints,
+                    f'User {message.author.mention} sent repeating message {message_content} {message_count} times in last {time_threshold_minutes} minutes in the same channel.',
+                    f'{message.author.mention}\nReason -- sending repeating message:\n{message_content}\nmultiple times in the same channel.',
+                    f'Deleted repeating message {message_content} {message_count} times in last {time_threshold_minutes} minutes in the same channel.')
+                return
 
         # now check if user has sent repeating messages in 3 or more channels in the last time_threshold_minutes minutes
-        # Also sort by length of message to make sure the longest message is deleted first
-        for message_content in sorted(message_channel_repeats_dict, key=lambda x: len(x), reverse=True):
-            channel_ids = message_channel_repeats_dict[message_content]
+        for message_key in message_keys:
+            message_content = message_key_texts[message_key]
+            channel_ids = user_window.channel_ids(message_key)
             if len(channel_ids) >= repeat_message_in_different_channel_threshold:
-                self.banned_users_id_list.append(author_id)
-                # timestamp of 1 day later - stop deleting user's messages after 1 day
-                self.banned_users_timestamp_dict[author_id] = discord.utils.utcnow() + datetime.timedelta(days=1)
-                # give user banned role
-                await self.guild.get_member(author_id).add_roles(discord.Object(id=BANNED_ROLE_ID))
-                # log
-                await self.bot.log(
-                    cog=self,
-                    user=self.guild.get_member(author_id),
-                    user_action=None,
-                    channel=message.channel,
-                    event=f'User {self.guild.get_member(author_id).mention} sent repeating message {message_content} in {len(channel_ids)} channels in last {time_threshold_minutes} minutes.',
-                    outcome='Banned')
-                # tell user they are banned
-                reason_of_ban_channel = self.guild.get_channel(REASON_OF_BAN_CHANNEL_ID)
-                await reason_of_ban_channel.send(
-                    f'{self.guild.get_member(author_id).mention}\nReason -- sending repeating message:\n{message_content}\nin multiple channels.')
-                # set the timestamp to right now - as we are now sure the user is properly banned
-                self.banned_users_timestamp_dict[author_id] = discord.utils.utcnow()
-
-                # delete the banned messages
-                for message_in_list in self.user_messages_dict[author_id]:
-                    if 'http://' in message_in_list.content or 'https://' in message_in_list.content:
-                        for chunk in message_in_list.content.split():
-                            if 'http://' in chunk or 'https://' in chunk:
-                                if chunk == message_content:
-                                    try:
-                                        await message_in_list.delete()
-                                    except discord.errors.NotFound:
-                                        pass
-                    else:
-                        if message_in_list.content == message_content:
-                            try:
-                                await message_in_list.delete()
-                            except discord.errors.NotFound:
-                                pass
+                self.mark_banned(author_id)
+                fingerprints = user_window.messages_with_key(message_key)
+                # delete record of the banned messages
+                self.forget_messages(author_id)
+                self.queue_ban_action(
+                    self.ban_user, message.author, message.channel, fingerprints,
+                    f'User {message.author.mention} sent repeating message {message_content} in {len(channel_ids)} channels in last {time_threshold_minutes} minutes.',
+                    f'{message.author.mention}\nReason -- sending repeating message:\n{message_content}\nin multiple channels.',
+                    f'Deleted repeating message {message_content} in {len(channel_ids)} channels in last {time_threshold_minutes} minutes.')
+                return
+
+        # now check if the same message was sent by many different users in the last time_threshold_minutes minutes.
+        # Only recently joined accounts count: long-standing members all wishing someone a happy birthday are not a
+        # spam cluster. So only their messages are in the cross-user index, and only their messages can complete a
+        # cluster.
+        if not recent_joiner:
+            return
+        for message_key in message_keys:
+            if self.cross_user_content_index.author_count(message_key) >= config.auto_ban_number_of_distinct_authors_repeat:
+                author_ids = self.cross_user_content_index.recent_authors(message_key, fingerprint.created_at)
+                self.queue_cluster_ban(author_ids, message_key, message_key_texts[message_key], message.channel)
+                return
+
+    def is_recent_joiner(self, author_id: int) -> bool:
+        """Whether the author is still a member, and joined within the last AUTO_BAN_CLUSTER_MEMBER_MAX_AGE_DAYS days."""
+        member = self.guild.get_member(author_id)
+        earliest = discord.utils.utcnow() - datetime.timedelta(days=self.bot.config.auto_ban_cluster_member_max_age_days)
+        return member is not None and member.joined_at is not None and member.joined_at > earliest
+
+    def queue_ban_action(self, action, *args) -> None:
+        """Queue action(*args) for the ban workers. The users it bans must already be marked as banned."""
+        self.ban_queue.put_nowait((action, args))
 
+    async def run_ban_worker(self) -> None:
+        """Carry out queued ban actions one at a time. BAN_WORKER_COUNT of these run side by side."""
+        while True:
+            action, args = await self.ban_queue.get()
+            try:
+                await action(*args)
+            except Exception as e:
+                # keep the worker alive, whatever went wrong only affects this one ban
                 await self.bot.log(
                     cog=self,
-                    user=self.guild.get_member(author_id),
+                    user=None,
                     user_action=None,
                     channel=None,
-                    event=f'Deleted repeating message {message_content} in {len(channel_ids)} channels in last {time_threshold_minutes} minutes.',
-                    outcome=None)
-                # delete record of the banned messages
-                del self.user_messages_dict[author_id]
-                return
+                    event=f'Ban action {action.__name__} failed.',
+                    outcome=f'Error: {e}')
+            finally:
+                self.ban_queue.task_done()
+
+    async def ban_user(self, member: discord.Member, channel: discord.TextChannel, fingerprints: list,
+                       event: str, reason: str, deletion_event: str) -> None:
+        """Ban worker action: give the user the banned role, tell them why, and delete the messages they were banned for."""
+        config = self.bot.config
+        try:
+            # give user banned role
+            await call_with_retry(member.add_roles, discord.Object(id=config.banned_role_id))
+            outcome = 'Banned'
+        except discord.errors.HTTPException as e:
+            # their messages are still deleted, and so is anything they send over the next day
+            outcome = f'Failed to give banned role: {e}'
+        # log
+        await self.bot.log(
+            cog=self,
+            user=member,
+            user_action=None,
+            channel=channel,
+            event=event,
+            outcome=outcome)
+        if outcome == 'Banned':
+            # tell user they are banned
+            reason_of_ban_channel = self.guild.get_channel(config.reason_of_ban_channel_id)
+            await call_with_retry(reason_of_ban_channel.send, reason)
+            # set the timestamp to right now - as we are now sure the user is properly banned
+            self.set_banned_timestamp(member.id, discord.utils.utcnow())
+
+        # delete the banned messages
+        deletion_report = await self.delete_fingerprinted_messages(fingerprints)
+        await self.bot.log(
+            cog=self,
+            user=member,
+            user_action=None,
+            channel=None,
+            event=deletion_event,
+            outcome=deletion_report)
+
+    async def ban_new_user(self, message: discord.Message) -> None:
+        """Ban worker action: ban a user who sent a link or attachment right after joining."""
+        config = self.bot.config
+        new_user_ban_threshold_seconds = config.auto_ban_new_user_threshold_seconds
+        event = f'User {message.author.mention} joined less than {new_user_ban_threshold_seconds} seconds ago, and sent a the message: {message.content} with attachment or link'
+        try:
+            # give user banned role
+            await call_with_retry(message.author.add_roles, discord.Object(id=config.banned_role_id))
+        except discord.errors.HTTPException as e:
+            # like ban_user: no reason of ban message for a ban that did not happen, but the message is still
+            # deleted, and so is anything they send over the next day
+            await self.bot.log(
+                cog=self,
+                user=message.author,
+                user_action=None,
+                channel=message.channel,
+                event=event,
+                outcome=f'Failed to give banned role: {e}')
+            try:
+                await call_with_retry(message.delete)
+            except discord.errors.NotFound:
+                pass
+            return
+        # set the timestamp to right now - as we are now sure the user is properly banned
+        self.set_banned_timestamp(message.author.id, discord.utils.utcnow())
+        # tell user they are banned, with the message as evidence, then delete it. Downloading the attachments
+        # can take a while, so this happens in the background rather than holding up the worker
+        self.start_background_task(self.post_new_user_evidence(message))
+        # log
+        await self.bot.log(
+            cog=self,
+            user=message.author,
+            user_action=None,
+            channel=message.channel,
+            event=event,
+            outcome='Banned')
+
+    def queue_cluster_ban(self, author_ids: list, message_key: int, message_content: str, channel: discord.TextChannel) -> None:
+        """
+        Ban every user who sent the same message, together: one log entry, one reason of ban message, and all their
+        copies of the message deleted in one go.
+        Authors who already got banned for it (the index remembers them for the detection period) are skipped, so a
+        latecomer posting the same message is banned on their own.
+        """
+        members = [self.guild.get_member(author_id) for author_id in author_ids
+                   if self.member_classes.get(author_id, MEMBER_NORMAL) == MEMBER_NORMAL]
+        members = [member for member in members if member is not None]
+        if not members:
+            return
+        fingerprints = []
+        for member in members:
+            self.mark_banned(member.id)
+            if member.id in self.user_messages_dict:
+                fingerprints += self.user_messages_dict[member.id].messages_with_key(message_key)
+            # delete record of the banned messages
+            self.forget_messages(member.id)
+        self.queue_ban_action(self.ban_cluster, members, len(author_ids), fingerprints, message_content, channel)
+
+    async def ban_cluster(self, members: list, author_count: int, fingerprints: list, message_content: str,
+                          channel: discord.TextChannel) -> None:
+        """Ban worker action: carry out a ban queued by queue_cluster_ban."""
+        config = self.bot.config
+        time_threshold_minutes = config.auto_ban_detection_period_minutes
+        # give users banned role
+        results = await asyncio.gather(
+            *[call_with_retry(member.add_roles, discord.Object(id=config.banned_role_id)) for member in members],
+            return_exceptions=True)
+        banned_members = [member for member, result in zip(members, results) if not isinstance(result, Exception)]
+        # set the timestamp to right now - as we are now sure the users are properly banned
+        for member in banned_members:
+            self.set_banned_timestamp(member.id, discord.utils.utcnow())
+        outcome = f'Banned {len(banned_members)} user(s).'
+        if len(banned_members) < len(members):
+            outcome += f' Failed to ban {len(members) - len(banned_members)} user(s).'
+        await self.bot.log(
+            cog=self,
+            user=None,
+            user_action=None,
+            channel=channel,
+            event=f'{author_count} different users sent repeating message {message_content} in last {time_threshold_minutes} minutes. Banned users are listed in the reason of ban channel.',
+            outcome=outcome)
+        # tell users they are banned
+        reason_of_ban_channel = self.guild.get_channel(config.reason_of_ban_channel_id)
+        reason = f'Reason -- sending repeating message:\n{message_content}\nas one of many different users.\n'
+        for reason_message in split_mentions_into_messages(reason, [member.mention for member in banned_members]):
+            await call_with_retry(reason_of_ban_channel.send, reason_message)
+
+        # delete the banned messages
+        deletion_report = await self.delete_fingerprinted_messages(fingerprints)
+        await self.bot.log(
+            cog=self,
+            user=None,
+            user_action=None,
+            channel=None,
+            event=f'Deleted repeating message {message_content} sent by {len(members)} different users in last {time_threshold_minutes} minutes.',
+            outcome=deletion_report)
+
+    def start_background_task(self, coroutine) -> None:
+        """Run coroutine without waiting for it, keeping a reference so it is not garbage collected halfway."""
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def post_new_user_evidence(self, message: discord.Message) -> None:
+        """
+        Post the reason a new user was banned, with a copy of their message, then delete the message.
+        Attachments are streamed to temporary files on disk and re-uploaded as long as they fit in AUTO_BAN_EVIDENCE_MAX_BYTES in total. The rest are saved to disk (see
+        save_evidence_attachment) and listed by name, size and path.
+        The message is only deleted once its attachments are downloaded, as they become unavailable with it.
+        """
+        config = self.bot.config
+        new_user_ban_threshold_seconds = config.auto_ban_new_user_threshold_seconds
+        files = []
+        too_large_attachments = []
+        try:
+            remaining_bytes = config.auto_ban_evidence_max_bytes
+            for attachment in message.attachments:
+                if attachment.size > remaining_bytes:
+                    too_large_attachments.append((attachment, await self.save_evidence_attachment(message, attachment)))
+                    continue
+                # a real file (not a SpooledTemporaryFile, which discord.File only accepts from Python 3.11)
+                temporary_file = await asyncio.to_thread(tempfile.TemporaryFile)
+                if await stream_download(self.attachment_fingerprinter.get_session(), attachment.url, temporary_file,
+                                         attachment.size, EVIDENCE_DOWNLOAD_TIMEOUT_SECONDS):
+                    temporary_file.seek(0)
+                    files.append(discord.File(temporary_file, filename=attachment.filename, spoiler=attachment.is_spoiler()))
+                    remaining_bytes -= attachment.size
+                else:
+                    temporary_file.close()
+                    too_large_attachments.append((attachment, 'could not be downloaded'))
+            reason = f'{message.author.mention}\nReason -- sending suspicious message:\n{message.content}\nwith attachment or link within {new_user_ban_threshold_seconds} seconds of joining the server.'
+            if too_large_attachments:
+                reason += '\nAttachments not re-uploaded:\n' + '\n'.join(
+                    f'{attachment.filename} ({attachment.size} bytes): {outcome}' for attachment, outcome in too_large_attachments)
+            reason_of_ban_channel = self.guild.get_channel(config.reason_of_ban_channel_id)
+            await reason_of_ban_channel.send(reason, files=files)
+        except Exception as e:
+            await self.bot.log(
+                cog=self,
+                user=message.author,
+                user_action=None,
+                channel=message.channel,
+                event='Failed to post the reason of ban with the message as evidence.',
+                outcome=f'Error: {e}')
+        finally:
+            for file in files:
+                file.close()
+
+        try:
+            await message.delete()
+        except discord.errors.NotFound:
+            pass
+        await self.bot.log(
+            cog=self,
+            user=message.author,
+            user_action='sent a message',
+            channel=message.channel,
+            event=f'user sent a message with attachment or link within {new_user_ban_threshold_seconds} seconds of joining the server',
+            outcome='deleted the message')
+
+    async def save_evidence_attachment(self, message: discord.Message, attachment: discord.Attachment):
+        """
+        Stream an evidence attachment too large to re-upload to a file under data/moderation/evidence/ (see
+        open_evidence_file), as its link stops working once the message is deleted, within EVIDENCE_FILE_MAX_BYTES
+        and EVIDENCE_DISK_MAX_BYTES. Return what happened to it, for the reason of ban message.
+        """
+        if attachment.size > EVIDENCE_FILE_MAX_BYTES:
+            return f'not saved, larger than {EVIDENCE_FILE_MAX_BYTES} bytes'
+        self.evidence_bytes_being_saved += attachment.size
+        try:
+            try:
+                file = await asyncio.to_thread(
+                    open_evidence_file, self.evidence_dir, message.id, attachment,
+                    self.evidence_bytes_being_saved - attachment.size)
+            except OSError as e:
+                return f'not saved: {e}'
+            if file is None:
+                return f'not saved, the saved evidence would take more than {EVIDENCE_DISK_MAX_BYTES} bytes'
+            try:
+                saved = await stream_download(self.attachment_fingerprinter.get_session(), attachment.url, file,
+                                              attachment.size, EVIDENCE_DOWNLOAD_TIMEOUT_SECONDS)
+            finally:
+                await asyncio.to_thread(file.close)
+        finally:
+            self.evidence_bytes_being_saved -= attachment.size
+        if not saved:
+            await asyncio.to_thread(os.remove, file.name)
+            return 'could not be downloaded'
+        path = os.path.relpath(file.name, os.path.join(self.moderation_dir, '..', '..'))
+        return f'saved on the bot\'s host as {path}'
+
+    async def delete_fingerprinted_messages(self, fingerprints: list) -> str:
+        """
+        Delete the messages behind the fingerprints.
+        Messages are grouped by channel, and the channels are worked through concurrently (at most
+        DELETION_CHANNEL_CONCURRENCY at a time), so a spammer's messages in many channels disappear together instead
+        of one round trip after another.
+        Return a line per channel of how the deletion went, to be logged in one entry.
+        """
+        fingerprints_by_channel = {}
+        for fingerprint in fingerprints:
+            fingerprints_by_channel.setdefault(fingerprint.channel_id, []).append(fingerprint)
+        semaphore = asyncio.Semaphore(DELETION_CHANNEL_CONCURRENCY)
+
+        async def delete_with_semaphore(channel_id: int, channel_fingerprints: list) -> str:
+            async with semaphore:
+                return await self.delete_fingerprinted_messages_in_channel(channel_id, channel_fingerprints)
+
+        channel_reports = await asyncio.gather(
+            *[delete_with_semaphore(channel_id, channel_fingerprints)
+              for channel_id, channel_fingerprints in fingerprints_by_channel.items()])
+        return '\n'.join(channel_reports)
+
+    async def delete_fingerprinted_messages_in_channel(self, channel_id: int, fingerprints: list) -> str:
+        """
+        Delete the messages behind the fingerprints, all from the same channel.
+        Messages young enough are bulk deleted, 100 per request. Older ones, and any bulk deletion Discord refuses, fall
+        back to deleting one by one. Messages already deleted are skipped.
+        Return a line describing how the deletion went.
+        """
+        channel = self.guild.get_channel_or_thread(channel_id)
+        if channel is None:
+            return f'<#{channel_id}> ({channel_id}): channel not found, {len(fingerprints)} message(s) not deleted'
+
+        bulk_cutoff = int(discord.utils.utcnow().timestamp()) - BULK_DELETE_MAX_AGE_SECONDS
+        one_by_one = [fingerprint for fingerprint in fingerprints if fingerprint.created_at <= bulk_cutoff]
+        bulk = [fingerprint for fingerprint in fingerprints if fingerprint.created_at > bulk_cutoff]
+        if not hasattr(channel, 'delete_messages'):
+            one_by_one += bulk
+            bulk = []
+
+        deleted_count = 0
+        failed_count = 0
+        for i in range(0, len(bulk), BULK_DELETE_MAX_MESSAGES):
+            chunk = bulk[i:i + BULK_DELETE_MAX_MESSAGES]
+            try:
+                await channel.delete_messages([discord.Object(id=fingerprint.message_id) for fingerprint in chunk])
+                deleted_count += len(chunk)
+            except discord.errors.NotFound:
+                # a single message (deleted without the bulk endpoint) that is already gone
+                pass
+            except discord.errors.HTTPException:
+                one_by_one += chunk
+        for fingerprint in one_by_one:
+            try:
+                await channel.get_partial_message(fingerprint.message_id).delete()
+                deleted_count += 1
+            except discord.errors.NotFound:
+                pass
+            except discord.errors.HTTPException:
+                failed_count += 1
+
+        report = f'{channel.mention} ({channel.id}): deleted {deleted_count} message(s)'
+        if failed_count:
+            report += f', failed to delete {failed_count}'
+        return report
 
     # on role add
     @commands.Cog.listener()
     async def on_member_update(self, before: discord.Member, after: discord.Member) -> None:
-        """When a user is unbanned (having @banned removed), record this and update variables."""
-        if BANNED_ROLE_ID in [role.id for role in before.roles] and BANNED_ROLE_ID not in [role.id for role in after.roles]:
-            if after.id in self.user_messages_dict:
-                del self.user_messages_dict[after.id]
-            if after.id in self.banned_users_id_list:
-                self.banned_users_id_list.remove(after.id)
+        """
+        Keep the member's classification up to date with their roles.
+        When a user is unbanned (having @banned removed), record this and update variables.
+        """
+        config = self.bot.config
+        if config.banned_role_id in [role.id for role in before.roles] and config.banned_role_id not in [role.id for role in after.roles]:
+            self.forget_messages(after.id)
+            if after.id in self.banned_users_id_set:
+                self.banned_users_id_set.remove(after.id)
+                self.state_store.record({'op': 'unban', 'user_id': after.id})
+            self.update_member_class(after)
             await self.bot.log(
                 cog=self,
                 user=after,
@@ -304,9 +1471,136 @@ class AutoBanningCog(commands.Cog):
                 channel=None,
                 event=f'User {after.mention} was unbanned.',
                 outcome=None)
+        elif before.roles != after.roles:
+            self.update_member_class(after)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member) -> None:
+        """
+        Classify the member as they join (they may be rejoining while we are still banning them).
+        Then feed the join rate monitor. When AUTO_BAN_RAID_JOIN_THRESHOLD or more members joined in the last
+        AUTO_BAN_RAID_JOIN_WINDOW_SECONDS seconds, switch to raid mode: everyone in that burst, and everyone joining
+        while the rate stays above the threshold, gets the banned role in one coordinated sweep instead of each
+        account being caught by on_message on its own.
+        Members who were in the server before are not counted or banned as raiders, and an
+        AUTO_BAN_RAID_JOIN_THRESHOLD of 0 turns raid detection off.
+        """
+        config = self.bot.config
+        self.update_member_class(member)
+        # bots can only be added by administrators
+        if member.bot:
+            return
+        # members coming back, e.g. everyone rejoining after a prune or a server migration (whose roles the role
+        # restoration queue gives back), are not a raid. Discord flags everyone who was a member before, so this
+        # includes everyone with saved roles
+        if member.flags.did_rejoin:
+            return
+        if config.auto_ban_raid_join_threshold == 0:
+            return
+        self.join_rate_monitor.add(int(discord.utils.utcnow().timestamp()), member.id)
+        if self.join_rate_monitor.count < config.auto_ban_raid_join_threshold:
+            if self.raid_mode:
+                await self.end_raid_mode()
+            return
+        if self.raid_mode:
+            self.restrict_raiders([member.id])
+            return
+        self.raid_mode = True
+        await self.bot.log(
+            cog=self,
+            user=None,
+            user_action=None,
+            channel=None,
+            event=f'Raid detected: {self.join_rate_monitor.count} members joined in the last {config.auto_ban_raid_join_window_seconds} seconds.',
+            outcome='Raid mode on, banning everyone in the burst.')
+        self.restrict_raiders(self.join_rate_monitor.member_ids())
+
+    async def end_raid_mode(self, event: str = None) -> None:
+        config = self.bot.config
+        self.raid_mode = False
+        await self.bot.log(
+            cog=self,
+            user=None,
+            user_action=None,
+            channel=None,
+            event=event or f'Fewer than {config.auto_ban_raid_join_threshold} members joined in the last {config.auto_ban_raid_join_window_seconds} seconds.',
+            outcome='Raid mode off.')
+
+    def restrict_raiders(self, member_ids: list) -> None:
+        """
+        Start banning the members: from now on their messages are deleted, and they are queued for the banned role.
+        Members who are administrators, already banned or being banned are skipped.
+        """
+        for member_id in member_ids:
+            if self.member_classes.get(member_id, MEMBER_NORMAL) != MEMBER_NORMAL:
+                continue
+            self.mark_banned(member_id)
+            self.raid_restriction_queue.append(member_id)
+        if self.raid_restriction_queue and (self.raid_restriction_task is None or self.raid_restriction_task.done()):
+            self.raid_restriction_task = asyncio.create_task(self.run_raid_restriction())
+
+    async def run_raid_restriction(self) -> None:
+        """
+        Give the banned role to the queued members, RAID_RESTRICTION_BATCH_SIZE at a time, pausing between batches so
+        the sweep does not run into Discord's rate limits. Members joining mid-sweep are picked up by the same sweep.
+        Log and tell the reason of ban channel once, when the queue is empty.
+        """
+        config = self.bot.config
+        banned_members = []
+        failed_count = 0
+        while self.raid_restriction_queue:
+            batch = [self.raid_restriction_queue.popleft()
+                     for _ in range(min(RAID_RESTRICTION_BATCH_SIZE, len(self.raid_restriction_queue)))]
+            results = await asyncio.gather(*[self.restrict_raider(member_id) for member_id in batch])
+            for result in results:
+                if isinstance(result, discord.Member):
+                    banned_members.append(result)
+                elif result is not None:
+                    failed_count += 1
+            if self.raid_restriction_queue:
+                await asyncio.sleep(RAID_RESTRICTION_BATCH_INTERVAL_SECONDS)
+
+        outcome = f'Banned {len(banned_members)} member(s).'
+        if failed_count:
+            outcome += f' Failed to ban {failed_count} member(s).'
+        await self.bot.log(
+            cog=self,
+            user=None,
+            user_action=None,
+            channel=None,
+            event='Raid sweep finished, banned members are listed in the reason of ban channel.',
+            outcome=outcome)
+        if banned_members:
+            reason_of_ban_channel = self.guild.get_channel(config.reason_of_ban_channel_id)
+            reason = f'Reason -- joining during a raid ({config.auto_ban_raid_join_threshold} or more accounts joining within {config.auto_ban_raid_join_window_seconds} seconds):\n'
+            for reason_message in split_mentions_into_messages(reason, [member.mention for member in banned_members]):
+                await reason_of_ban_channel.send(reason_message)
+
+    async def restrict_raider(self, member_id: int):
+        """
+        Give one raider the banned role.
+        Return the member if banned, None if they already left, or the exception if giving the role failed.
+        """
+        config = self.bot.config
+        member = self.guild.get_member(member_id)
+        if member is None:
+            return None
+        try:
+            await call_with_retry(member.add_roles, discord.Object(id=config.banned_role_id), reason='Joined during a raid')
+        except discord.errors.HTTPException as e:
+            return e
+        # set the timestamp to right now - as we are now sure the user is properly banned
+        self.set_banned_timestamp(member_id, discord.utils.utcnow())
+        return member
+
+    @commands.Cog.listener()
+    async def on_raw_member_remove(self, payload: discord.RawMemberRemoveEvent) -> None:
+        """Forget the member's classification, unless we are still banning them."""
+        if payload.user.id not in self.banned_users_id_set:
+            self.member_classes.pop(payload.user.id, None)
 
 
 async def setup(bot: commands.Bot) -> None:
     await bot.add_cog(
         AutoBanningCog(bot),
-        guilds=[discord.Object(id=SERVER_ID)])
+        guilds=[discord.Object(id=bot.config.server_id)])
@@ -1,57 +1,261 @@
 import os
-from dotenv import load_dotenv
 import discord
+from discord import app_commands
 from discord.ext import commands
 import csv
+import asyncio
+import json
+import time
+from config import STARTUP_CONFIG
+from state_files import FileSaver, QueuedFileWriter, append_to_file, write_file_atomically
 
 
-load_dotenv()
-SERVER_ID = int(os.getenv('SERVER_ID'))
-ADMINISTRATION_ROLES_IDS = [int(role_id) for role_id in os.getenv('ADMINISTRATION_ROLES_IDS').split(',')]
-DO_NOT_RE_GIVE_ROLES_IDS = [int(role_id) for role_id in os.getenv('DO_NOT_RE_GIVE_ROLES_IDS').split(',')]
+# needed when the commands are defined, so these only change on a restart
+SERVER_ID = STARTUP_CONFIG.server_id
+ADMINISTRATION_ROLES_IDS = STARTUP_CONFIG.administration_roles_ids
 
-class LeavingMemberRoleLoggingAndRegivingCog(commands.Cog):
-    def __init__(self, bot: commands.Bot):
-        self.bot = bot
-        self.moderation_dir = None
-        self.left_users_roles_csv_full_path = None
-        self.users_ids_roles_ids = {}
 
-    @commands.Cog.listener()
-    async def on_ready(self):
-        """
-        On ready, check of a role logging file exists, if not, create it.
-        Load the file into memory. Newer entries about the same user will overwrite older entries.
-        """
+# The role logging file is compacted (rewritten with only the latest entry of each user) once it has more than
+# LEFT_USERS_ROLES_COMPACTION_RATIO times as many rows as users, and at least LEFT_USERS_ROLES_COMPACTION_MIN_ROWS rows.
+LEFT_USERS_ROLES_COMPACTION_RATIO = 2
+LEFT_USERS_ROLES_COMPACTION_MIN_ROWS = 1000
 
-        """
-        The role logging file is a csv file with the following format:
+# Rejoining members get their roles back through a queue, so hundreds rejoining at once (after a prune or a server
+# migration) do not all hit the API together: ROLE_RESTORATION_WORKER_COUNT members at a time, and on average at most
+# ROLE_RESTORATIONS_PER_SECOND per second, in bursts of up to ROLE_RESTORATION_BURST.
+ROLE_RESTORATION_WORKER_COUNT = 2
+ROLE_RESTORATIONS_PER_SECOND = 1
+ROLE_RESTORATION_BURST = 5
+
+# The startup reconciliation (see reconcile_member_roles) yields to other events every
+# MEMBER_ROLES_RECONCILIATION_BATCH_SIZE members. The member roles snapshot is saved at most every
+# MEMBER_ROLES_SNAPSHOT_SAVE_INTERVAL_SECONDS seconds while the bot runs, and when the Cog is unloaded.
+MEMBER_ROLES_RECONCILIATION_BATCH_SIZE = 500
+MEMBER_ROLES_SNAPSHOT_SAVE_INTERVAL_SECONDS = 60
+
+
+class LeftUsersRolesStore:
+    """
+    The roles of every user who left, kept in memory as users_ids_roles_ids (user id -> list of role ids) and on disk
+    in a csv file with the following format:
         user_id,role_ids
         <USER_ID>,"<ROLE_ID_1>,<ROLE_ID_2>,<ROLE_ID_3>,<ROLE_ID_4>,<ROLE_ID_5>"
         <USER_ID>,"<ROLE_ID_1>,<ROLE_ID_2>"
         <USER_ID>,"<ROLE_ID_1>"
-        """
 
-        # Get file path
-        curr_dir = os.path.abspath(os.path.dirname(__file__))
-        self.moderation_dir = os.path.join(curr_dir, '..', '..', 'data', 'moderation')
-        self.left_users_roles_csv_full_path = os.path.join(self.moderation_dir, 'left_users_roles.csv')
+    A user leaving appends a row, and newer rows about the same user overwrite older ones when the file is loaded.
+    So the file does not keep growing as the same people leave and rejoin, it is compacted to the latest row of each
+    user when it gets too big (see LEFT_USERS_ROLES_COMPACTION_RATIO), keeping its size in line with the number of users.
 
-        # Check if file exists
-        if not os.path.isfile(self.left_users_roles_csv_full_path):
-            # File does not exist
-            os.makedirs(self.moderation_dir, exist_ok=True)
-            with open(self.left_users_roles_csv_full_path, 'w') as file:
+    The file is only ever written by the writer (see QueuedFileWriter). Rows and compactions go through the same queue,
+    so a compaction always covers exactly the rows queued before it.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = os.path.join(directory, 'left_users_roles.csv')
+        self.users_ids_roles_ids = {}
+        # rows in the file (or queued for it), including overwritten ones
+        self.row_count = 0
+        self.writer = QueuedFileWriter(self.write_items, 'left users roles')
+
+    def load(self) -> tuple:
+        """
+        Read the file, creating it if it does not exist. Return the roles in it (user id -> list of role ids) and its
+        number of rows, to be passed to merge_loaded.
+        Blocking, call through asyncio.to_thread before starting the writer. Only reads the file, as record may
+        change the roles in memory at the same time.
+        """
+        if not os.path.isfile(self.path):
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path, 'w') as file:
                 # Write header: user_id, role_ids
                 file.write('user_id,role_ids\n')
-
-        # Load file into memory
-        with open(self.left_users_roles_csv_full_path, 'r') as file:
+        users_ids_roles_ids = {}
+        row_count = 0
+        with open(self.path, 'r') as file:
             reader = csv.reader(file)
             next(reader)
             for row in reader:
-                # This way of storing the data will overwrite older entries about the same user
-                self.users_ids_roles_ids[int(row[0])] = [int(role_id) for role_id in row[1].split(',')] if len(row[1]) > 0 else []
+                users_ids_roles_ids[int(row[0])] = [int(role_id) for role_id in row[1].split(',')] if len(row[1]) > 0 else []
+                row_count += 1
+        return users_ids_roles_ids, row_count
+
+    def merge_loaded(self, users_ids_roles_ids: dict, row_count: int) -> None:
+        """Merge what load read from the file into memory, and queue a compaction if needed. Never blocks."""
+        # members who left before the file was loaded are newer than anything in it (their rows are still queued)
+        users_ids_roles_ids.update(self.users_ids_roles_ids)
+        self.users_ids_roles_ids = users_ids_roles_ids
+        self.row_count += row_count
+        if self.needs_compaction():
+            self.writer.put('compact', self.get_compacted())
+            self.row_count = len(self.users_ids_roles_ids)
+
+    @staticmethod
+    def get_row(user_id: int, role_ids: list) -> str:
+        return f'{user_id},"{",".join([str(role_id) for role_id in role_ids])}"\n'
+
+    def get_compacted(self) -> str:
+        """The whole file with only the latest row of each user."""
+        return 'user_id,role_ids\n' + ''.join(self.get_row(user_id, role_ids) for user_id, role_ids in self.users_ids_roles_ids.items())
+
+    def needs_compaction(self) -> bool:
+        return self.row_count >= max(LEFT_USERS_ROLES_COMPACTION_MIN_ROWS, LEFT_USERS_ROLES_COMPACTION_RATIO * len(self.users_ids_roles_ids))
+
+    def record(self, user_id: int, role_ids: list) -> None:
+        """Update the roles in memory and queue the row (or a compaction) for the file. Never blocks."""
+        self.users_ids_roles_ids[user_id] = role_ids
+        self.row_count += 1
+        if self.needs_compaction():
+            self.writer.put('compact', self.get_compacted())
+            self.row_count = len(self.users_ids_roles_ids)
+        else:
+            self.writer.put('row', self.get_row(user_id, role_ids))
+
+    def write_items(self, items: list) -> None:
+        rows = []
+        for kind, data in items:
+            if kind == 'row':
+                rows.append(data)
+            elif kind == 'compact':
+                # the rows so far are covered by the compacted file
+                rows = []
+                write_file_atomically(self.path, data)
+        if rows:
+            append_to_file(self.path, ''.join(rows))
+
+
+class TokenBucket:
+    """Paces work to rate per second on average, letting through bursts of up to capacity."""
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    async def acquire(self) -> None:
+        """Wait until a token is available, and take it."""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RoleRestorationQueue:
+    """
+    The ids of the rejoined members waiting for their roles back, in the order they joined.
+    They are also kept on disk as a JSON list, so a restart resumes the restorations instead of dropping them.
+    A member stays in pending until their roles are given, so one being restored when the bot stops is restored again
+    after the restart.
+
+    The file is only written by the saver (see FileSaver).
+    """
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, 'role_restoration_queue.json')
+        # user id -> None, a set that keeps the order the users were added in
+        self.pending = {}
+        self.queue = asyncio.Queue()
+        self.saver = FileSaver(lambda: json.dumps(list(self.pending)), self.save, 'role restoration queue')
+        # since the bot started, shown by the role_restoration_status command
+        self.restored_count = 0
+        self.skipped_count = 0
+
+    def load(self) -> list:
+        """The user ids still pending when the bot stopped. Blocking, call through asyncio.to_thread."""
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path, 'r') as file:
+            return json.load(file)
+
+    def add(self, user_id: int) -> None:
+        if user_id in self.pending:
+            return
+        self.pending[user_id] = None
+        self.queue.put_nowait(user_id)
+        self.saver.mark_changed()
+
+    def remove(self, user_id: int) -> None:
+        self.pending.pop(user_id, None)
+        self.saver.mark_changed()
+
+    def save(self, data: str) -> None:
+        write_file_atomically(self.path, data)
+
+
+class MemberRolesSnapshot:
+    """
+    The roles of every member of the server (user id -> list of role ids, without @everyone), kept up to date while
+    the bot runs and saved to disk as JSON, so the next start can tell who left while the bot was offline.
+
+    The file is only written by the saver (see FileSaver), at most every MEMBER_ROLES_SNAPSHOT_SAVE_INTERVAL_SECONDS.
+    Saving only starts once members_roles holds every member (see start), otherwise the members missing from it would
+    look like they left.
+    """
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, 'member_roles_snapshot.json')
+        self.members_roles = {}
+        self.saver = FileSaver(
+            lambda: json.dumps(self.members_roles, separators=(',', ':')), self.save, 'member roles snapshot',
+            MEMBER_ROLES_SNAPSHOT_SAVE_INTERVAL_SECONDS)
+
+    def load(self) -> dict:
+        """The snapshot saved by the last run, empty if there is none. Blocking, call through asyncio.to_thread."""
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path, 'r') as file:
+            return {int(user_id): role_ids for user_id, role_ids in json.load(file).items()}
+
+    def update(self, member: discord.Member) -> None:
+        self.members_roles[member.id] = [role.id for role in member.roles][1:]  # exclude @everyone
+        self.saver.mark_changed()
+
+    def remove(self, user_id: int) -> None:
+        self.members_roles.pop(user_id, None)
+        self.saver.mark_changed()
+
+    def start(self) -> None:
+        """Start saving the snapshot, once members_roles holds every member."""
+        self.saver.mark_changed()
+        self.saver.start()
+
+    def save(self, data: str) -> None:
+        write_file_atomically(self.path, data)
+
+
+class LeavingMemberRoleLoggingAndRegivingCog(commands.Cog):
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        curr_dir = os.path.abspath(os.path.dirname(__file__))
+        self.moderation_dir = os.path.join(curr_dir, '..', '..', 'data', 'moderation')
+        self.left_users_roles_store = LeftUsersRolesStore(self.moderation_dir)
+        self.role_restoration_queue = RoleRestorationQueue(self.moderation_dir)
+        self.role_restoration_bucket = TokenBucket(ROLE_RESTORATIONS_PER_SECOND, ROLE_RESTORATION_BURST)
+        self.role_restoration_workers = []
+        self.member_roles_snapshot = MemberRolesSnapshot(self.moderation_dir)
+        # ids of the users whose roles were logged by on_raw_member_remove since the bot started
+        self.left_since_start_ids = set()
+        self.reconciliation_task = None
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        """
+        On the first ready, load the role logging file into memory (see LeftUsersRolesStore), and resume the role
+        restorations still pending when the bot stopped (see RoleRestorationQueue). Then, in the background, log the
+        roles of the members who left while the bot was offline (see reconcile_member_roles).
+        on_ready also fires after reconnecting, when the roles in memory are already up to date and are kept.
+        """
+        if not self.left_users_roles_store.writer.is_started():
+            self.left_users_roles_store.merge_loaded(*await asyncio.to_thread(self.left_users_roles_store.load))
+            self.left_users_roles_store.writer.start()
+            for user_id in await asyncio.to_thread(self.role_restoration_queue.load):
+                self.role_restoration_queue.add(user_id)
+            self.role_restoration_queue.saver.start()
+            self.role_restoration_workers = [
+                asyncio.create_task(self.run_role_restoration_worker()) for _ in range(ROLE_RESTORATION_WORKER_COUNT)]
+            self.reconciliation_task = asyncio.create_task(self.reconcile_member_roles())
         await self.bot.log(
             cog=self,
             user=None,
@@ -60,6 +264,15 @@ class LeavingMemberRoleLoggingAndRegivingCog(commands.Cog):
             event='LeavingMemberRoleLoggingCog is ready.',
             outcome=None)
 
+    async def cog_unload(self) -> None:
+        if self.reconciliation_task is not None:
+            self.reconciliation_task.cancel()
+        for worker in self.role_restoration_workers:
+            worker.cancel()
+        await self.member_roles_snapshot.saver.close()
+        await self.role_restoration_queue.saver.close()
+        await self.left_users_roles_store.writer.close()
+
     @commands.Cog.listener()
     async def on_raw_member_remove(self, payload: discord.RawMemberRemoveEvent) -> None:
         """
@@ -68,9 +281,9 @@ class LeavingMemberRoleLoggingAndRegivingCog(commands.Cog):
         """
         user_id = payload.user.id
         role_ids = [role.id for role in payload.user.roles][1:]  # exclude @everyone
-        self.users_ids_roles_ids[user_id] = role_ids
-        with open(self.left_users_roles_csv_full_path, 'a') as file:
-            file.write(f'{user_id},"{",".join([str(role_id) for role_id in role_ids])}"\n')
+        self.left_users_roles_store.record(user_id, role_ids)
+        self.left_since_start_ids.add(user_id)
+        self.member_roles_snapshot.remove(user_id)
         await self.bot.log(
             cog=self,
             user=payload.user,
@@ -84,33 +297,151 @@ class LeavingMemberRoleLoggingAndRegivingCog(commands.Cog):
         """
         On member join, check if the member has left before, if so, give them their roles back.
         """
-        if member.id in self.users_ids_roles_ids:
-            guild = member.guild
-            for role_id in self.users_ids_roles_ids[member.id]:
-                # Don't give back certain roles
-                if role_id in DO_NOT_RE_GIVE_ROLES_IDS or role_id in ADMINISTRATION_ROLES_IDS:
-                    continue
+        self.member_roles_snapshot.update(member)
+        if member.id in self.left_users_roles_store.users_ids_roles_ids:
+            self.role_restoration_queue.add(member.id)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member) -> None:
+        """Keep the member roles snapshot up to date."""
+        if before.roles != after.roles:
+            self.member_roles_snapshot.update(after)
+
+    async def reconcile_member_roles(self) -> None:
+        """
+        on_raw_member_remove only sees members leaving while the bot is running. Compare the members of the server
+        with the snapshot saved by the last run, and log the roles (as of the snapshot) of everyone who left in
+        between, so they still get them back when they rejoin.
+        Runs in the background after the first ready, yielding to other events every MEMBER_ROLES_RECONCILIATION_BATCH_SIZE
+        members, so it never delays the bot on a big server.
+        """
+        guild = self.bot.get_guild(self.bot.config.server_id)
+        if not guild.chunked:
+            await guild.chunk()
+        previous_members_roles = await asyncio.to_thread(self.member_roles_snapshot.load)
+        # members who left since the bot started were already logged, with newer roles than the snapshot's
+        left_while_offline_ids = previous_members_roles.keys() - {member.id for member in guild.members} - self.left_since_start_ids
+        for user_id in left_while_offline_ids:
+            self.left_users_roles_store.record(user_id, previous_members_roles[user_id])
+        # the listeners keep updating this same dict while it is filled, so changes made in between are not lost
+        self.member_roles_snapshot.members_roles = {}
+        for i, member in enumerate(list(guild.members)):
+            if i % MEMBER_ROLES_RECONCILIATION_BATCH_SIZE == 0:
+                await asyncio.sleep(0)
+            # a member who left in between was already removed from the guild's members and logged
+            if guild.get_member(member.id) is not None:
+                self.member_roles_snapshot.members_roles[member.id] = [role.id for role in member.roles][1:]
+        self.member_roles_snapshot.start()
+        await self.bot.log(
+            cog=self,
+            user=None,
+            user_action=None,
+            channel=None,
+            event=f'Reconciled the roles of {len(self.member_roles_snapshot.members_roles)} members.',
+            outcome=f'Logged the roles of {len(left_while_offline_ids)} members who left while the bot was offline: {sorted(left_while_offline_ids)}'[:1024])
+
+    async def run_role_restoration_worker(self) -> None:
+        """Give queued members their roles back, paced by role_restoration_bucket."""
+        while True:
+            user_id = await self.role_restoration_queue.queue.get()
+            await self.role_restoration_bucket.acquire()
+            guild = self.bot.get_guild(self.bot.config.server_id)
+            # the member may have left again while waiting
+            member = guild.get_member(user_id) if guild is not None else None
+            role_ids = self.left_users_roles_store.users_ids_roles_ids.get(user_id)
+            if member is None or role_ids is None:
+                self.role_restoration_queue.skipped_count += 1
+            else:
                 try:
-                    role = guild.get_role(role_id)
-                    await member.add_roles(role)
+                    await self.restore_roles(member, role_ids)
+                    self.role_restoration_queue.restored_count += 1
                 except Exception as e:
+                    # keep the worker running, the member is dropped from the queue rather than retried forever
+                    self.role_restoration_queue.skipped_count += 1
                     await self.bot.log(
                         cog=self,
                         user=member,
                         user_action="Rejoined the server",
                         channel=None,
-                        event=f'Failed to give role: {role_id}',
-                        outcome=None
-                    )
+                        event='Failed to give roles back',
+                        outcome=f'Error: {e}')
+            self.role_restoration_queue.remove(user_id)
 
+    async def restore_roles(self, member: discord.Member, role_ids: list) -> None:
+        """
+        Give the member back the roles in role_ids, except the ones that are not given back (DO_NOT_RE_GIVE_ROLES_IDS
+        and ADMINISTRATION_ROLES_IDS) and the ones that cannot be given (deleted, managed by an integration, or not
+        below the bot's top role).
+        All roles are given in a single request (one audit log entry). Only if that fails, they are given one by one,
+        so one bad role does not stop the others.
+        """
+        config = self.bot.config
+        guild = member.guild
+        roles = []
+        skipped_role_ids = []
+        for role_id in set(role_ids) - config.do_not_re_give_roles_ids - config.administration_roles_ids:
+            role = guild.get_role(role_id)
+            if role is not None and role.is_assignable():
+                roles.append(role)
+            else:
+                skipped_role_ids.append(role_id)
+        failed_roles = []
+        if roles:
+            try:
+                # atomic=False sends every role in one request, atomic=True would send one request per role
+                await member.add_roles(*roles, reason='Re-giving the roles held before leaving', atomic=False)
+            except discord.HTTPException:
+                for role in roles:
+                    try:
+                        await member.add_roles(role, reason='Re-giving the roles held before leaving')
+                    except discord.HTTPException:
+                        failed_roles.append(role)
+        for role in failed_roles:
             await self.bot.log(
                 cog=self,
                 user=member,
                 user_action="Rejoined the server",
                 channel=None,
-                event=f'Given roles: {[guild.get_role(role_id).mention for role_id in self.users_ids_roles_ids[member.id]]}',
+                event=f'Failed to give role: {role.mention}',
                 outcome=None
             )
+        await self.bot.log(
+            cog=self,
+            user=member,
+            user_action="Rejoined the server",
+            channel=None,
+            event=f'Given roles: {[role.mention for role in roles if role not in failed_roles]}',
+            outcome=f'Could not give deleted or higher roles: {skipped_role_ids}' if skipped_role_ids else None
+        )
+
+    @app_commands.command(
+        name='role_restoration_status',
+        description='Show how many rejoined members are waiting for their roles back')
+    @app_commands.guilds(SERVER_ID)
+    @app_commands.checks.has_any_role(*ADMINISTRATION_ROLES_IDS)
+    async def role_restoration_status(
+            self,
+            interaction: discord.Interaction) -> None:
+        """
+        Show the progress of the role restoration queue: members waiting, being restored right now, and restored or
+        skipped (left again, or nothing saved) since the bot started.
+        """
+        restoration_queue = self.role_restoration_queue
+        waiting_count = restoration_queue.queue.qsize()
+        in_progress_count = len(restoration_queue.pending) - waiting_count
+        status = (f'Waiting: {waiting_count}\n'
+                  f'In progress: {in_progress_count}\n'
+                  f'Restored since start: {restoration_queue.restored_count}\n'
+                  f'Skipped since start: {restoration_queue.skipped_count}\n'
+                  f'Pace: {ROLE_RESTORATIONS_PER_SECOND} per second, {ROLE_RESTORATION_WORKER_COUNT} at a time')
+        await interaction.response.send_message(status, ephemeral=True)
+        await self.bot.log(
+            cog=self,
+            user=interaction.user,
+            user_action='Called role_restoration_status.',
+            channel=interaction.channel,
+            event=None,
+            outcome=status)
 
 
 async def setup(bot: commands.Bot) -> None:
@@ -1,5 +1,4 @@
 import os
-from dotenv import load_dotenv
 import discord
 from discord import app_commands
 from discord.app_commands import Choice
@@ -7,12 +6,12 @@ from discord.ext import commands
 from typing import Optional, List
 import datetime
 import csv
+from config import STARTUP_CONFIG
 
 
-load_dotenv()
-SERVER_ID = int(os.getenv('SERVER_ID'))
-ADMINISTRATION_ROLES_IDS = [int(role_id) for role_id in os.getenv('ADMINISTRATION_ROLES_IDS').split(',')]
-LOG_CHANNEL_ID = int(os.getenv('LOG_CHANNEL_ID'))
+# needed when the commands are defined, so these only change on a restart
+SERVER_ID = STARTUP_CONFIG.server_id
+ADMINISTRATION_ROLES_IDS = STARTUP_CONFIG.administration_roles_ids
 
 
 def embed_surpassed_limit(embeds: List[discord.Embed]) -> bool:
@@ -326,7 +325,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                         text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
                     embed.timestamp = datetime.datetime.now()
                     previous_rules_embeds.append(embed)
-                log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+                log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
                 # Send log message, mention it is a rule change.
                 await log_channel.send(content=f'**Server Rule Changed:**')
                 await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -496,7 +495,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                         text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
                     embed.timestamp = datetime.datetime.now()
                     previous_rules_embeds.append(embed)
-                log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+                log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
                 # Send log message, mention it is a rule change.
                 await log_channel.send(content=f'**Server Rule Changed:**')
                 await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -735,7 +734,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                 text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
             embed.timestamp = datetime.datetime.now()
             previous_rules_embeds.append(embed)
-        log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
         # Send log message, mention it is a rule change.
         await log_channel.send(content=f'**Server Rule Changed:**')
         await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -924,7 +923,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                 text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
             embed.timestamp = datetime.datetime.now()
             previous_rules_embeds.append(embed)
-        log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
         # Send log message, mention it is a rule change.
         await log_channel.send(content=f'**Server Rule Changed:**')
         await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -1105,7 +1104,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                 text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
             embed.timestamp = datetime.datetime.now()
             previous_rules_embeds.append(embed)
-        log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
         # Send log message, mention it is a rule change.
         await log_channel.send(content=f'**Server Rule Changed:**')
         await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -1301,7 +1300,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                 text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
             embed.timestamp = datetime.datetime.now()
             previous_rules_embeds.append(embed)
-        log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
         # Send log message, mention it is a rule change.
         await log_channel.send(content=f'**Server Rule Changed:**')
         await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -1493,7 +1492,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                 text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
             embed.timestamp = datetime.datetime.now()
             previous_rules_embeds.append(embed)
-        log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
         # Send log message, mention it is a rule change.
         await log_channel.send(content=f'**Server Rule Changed:**')
         await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -1664,7 +1663,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                 text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
             embed.timestamp = datetime.datetime.now()
             previous_rules_embeds.append(embed)
-        log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
         # Send log message, mention it is a rule change.
         await log_channel.send(content=f'**Server Rule Changed:**')
         await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -1838,7 +1837,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                 text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
             embed.timestamp = datetime.datetime.now()
             previous_rules_embeds.append(embed)
-        log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
         # Send log message, mention it is a rule change.
         await log_channel.send(content=f'**Server Rule Changed:**')
         await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -2023,7 +2022,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                 text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
             embed.timestamp = datetime.datetime.now()
             previous_rules_embeds.append(embed)
-        log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
         # Send log message, mention it is a rule change.
         await log_channel.send(content=f'**Server Rule Changed:**')
         await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -2169,7 +2168,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                 text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
             embed.timestamp = datetime.datetime.now()
             previous_rules_embeds.append(embed)
-        log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
         # Send log message, mention it is a rule change.
         await log_channel.send(content=f'**Server Rule Changed:**')
         await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -2347,7 +2346,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                 text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
             embed.timestamp = datetime.datetime.now()
             previous_rules_embeds.append(embed)
-        log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
         # Send log message, mention it is a rule change.
         await log_channel.send(content=f'**Server Rule Changed:**')
         await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -2529,7 +2528,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                 text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
             embed.timestamp = datetime.datetime.now()
             previous_rules_embeds.append(embed)
-        log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
         # Send log message, mention it is a rule change.
         await log_channel.send(content=f'**Server Rule Changed:**')
         await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -2685,7 +2684,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                 text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
             embed.timestamp = datetime.datetime.now()
             previous_rules_embeds.append(embed)
-        log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
         # Send log message, mention it is a rule change.
         await log_channel.send(content=f'**Server Rule Changed:**')
         await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -2831,7 +2830,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                 text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
             embed.timestamp = datetime.datetime.now()
             previous_rules_embeds.append(embed)
-        log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
         # Send log message, mention it is a rule change.
         await log_channel.send(content=f'**Server Rule Changed:**')
         await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -3009,7 +3008,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                 text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
             embed.timestamp = datetime.datetime.now()
             previous_rules_embeds.append(embed)
-        log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
         # Send log message, mention it is a rule change.
         await log_channel.send(content=f'**Server Rule Changed:**')
         await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
@@ -3187,7 +3186,7 @@ class ServerRulesCog(commands.GroupCog, name='rules'):
                 text=f'Before update by {interaction.user.name + (("#" + interaction.user.discriminator) if len(interaction.user.discriminator) > 1 else "")}: ({datetime.datetime.now().astimezone().tzinfo.tzname(datetime.datetime.now().astimezone())})')
             embed.timestamp = datetime.datetime.now()
             previous_rules_embeds.append(embed)
-        log_channel = self.bot.get_channel(LOG_CHANNEL_ID)
+        log_channel = self.bot.get_channel(self.bot.config.log_channel_id)
         # Send log message, mention it is a rule change.
         await log_channel.send(content=f'**Server Rule Changed:**')
         await log_channel.send(content=self.server_rule_message_content, embeds=previous_rules_embeds)
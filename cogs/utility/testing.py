@@ -1,15 +1,14 @@
-import os
-from dotenv import load_dotenv
 import discord
 from discord import app_commands
 from discord.app_commands import Choice
 from discord.ext import commands
 from typing import Optional
+from config import STARTUP_CONFIG
 
 
-load_dotenv()
-SERVER_ID = int(os.getenv('SERVER_ID'))
-ADMINISTRATION_ROLES_IDS = [int(role_id) for role_id in os.getenv('ADMINISTRATION_ROLES_IDS').split(',')]
+# needed when the commands are defined, so these only change on a restart
+SERVER_ID = STARTUP_CONFIG.server_id
+ADMINISTRATION_ROLES_IDS = STARTUP_CONFIG.administration_roles_ids
 
 
 class TestingCog(commands.Cog):
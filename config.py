@@ -0,0 +1,126 @@
+import os
+from dotenv import dotenv_values
+
+
+# Variables that can only take effect on a restart: they identify the bot and the server, or are baked into the slash
+# commands (guilds and role checks) when the cogs are imported. Changing them and reloading only logs a warning.
+RESTART_ONLY_VARIABLES = (
+    'APPLICATION_ID', 'DISCORD_BOT_TOKEN', 'SERVER_ID', 'ADMINISTRATION_ROLES_IDS', 'MEMBER_CACHE_FLAGS', 'MAX_MESSAGES')
+
+
+def get_int(environment: dict, name: str, default: int = None) -> int:
+    value = environment.get(name)
+    if value is None or value.strip() == '':
+        if default is None:
+            raise ValueError(f'{name} is not set')
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'{name} is not a whole number: {value!r}')
+
+
+def get_id_set(environment: dict, name: str) -> frozenset:
+    """Comma-separated ids, e.g. ADMINISTRATION_ROLES_IDS=123,456"""
+    value = environment.get(name)
+    if value is None:
+        raise ValueError(f'{name} is not set')
+    try:
+        return frozenset(int(item) for item in value.split(',') if item.strip())
+    except ValueError:
+        raise ValueError(f'{name} is not a list of comma-separated ids: {value!r}')
+
+
+def get_name_set(environment: dict, name: str, choices: tuple, default: tuple) -> frozenset:
+    """Comma-separated names out of choices, e.g. MEMBER_CACHE_FLAGS=joined,voice"""
+    value = environment.get(name)
+    if value is None:
+        return frozenset(default)
+    names = frozenset(item.strip() for item in value.split(',') if item.strip())
+    if not names <= set(choices):
+        raise ValueError(f'{name} can only list {", ".join(choices)}: {value!r}')
+    return names
+
+
+class Config:
+    """
+    The bot's configuration (see the Environment Variables section of README.md), parsed into ints and frozensets.
+    A Config is never changed after it is made: reloading makes a new one, and Bot.reload_config swaps it in as
+    bot.config in a single assignment, so a cog reading bot.config always sees one consistent configuration.
+    """
+    __slots__ = (
+        'application_id', 'discord_bot_token', 'command_prefix', 'server_id', 'log_channel_id', 'banned_role_id',
+        'administration_roles_ids', 'reason_of_ban_channel_id', 'do_not_re_give_roles_ids',
+        'auto_ban_number_of_repeat_in_same_channel', 'auto_ban_number_of_different_channel_repeat',
+        'auto_ban_character_length_minimum', 'auto_ban_detection_period_minutes',
+        'auto_ban_new_user_threshold_seconds', 'auto_ban_near_duplicate_max_distance',
+        'auto_ban_number_of_distinct_authors_repeat', 'auto_ban_cluster_member_max_age_days', 'auto_ban_evidence_max_bytes', 'auto_ban_raid_join_threshold',
+        'auto_ban_raid_join_window_seconds', 'member_cache_flags', 'max_messages')
+
+    def __init__(self, environment: dict):
+        """Parse the variables out of environment. Raise ValueError naming the variable if one is missing or invalid."""
+        self.application_id = get_int(environment, 'APPLICATION_ID')
+        self.discord_bot_token = environment.get('DISCORD_BOT_TOKEN')
+        if not self.discord_bot_token:
+            raise ValueError('DISCORD_BOT_TOKEN is not set')
+        self.command_prefix = environment.get('COMMAND_PREFIX')
+        if not self.command_prefix:
+            raise ValueError('COMMAND_PREFIX is not set')
+        self.server_id = get_int(environment, 'SERVER_ID')
+        self.log_channel_id = get_int(environment, 'LOG_CHANNEL_ID')
+        self.banned_role_id = get_int(environment, 'BANNED_ROLE_ID')
+        self.administration_roles_ids = get_id_set(environment, 'ADMINISTRATION_ROLES_IDS')
+        self.reason_of_ban_channel_id = get_int(environment, 'REASON_OF_BAN_CHANNEL_ID')
+        self.do_not_re_give_roles_ids = get_id_set(environment, 'DO_NOT_RE_GIVE_ROLES_IDS')
+        self.auto_ban_number_of_repeat_in_same_channel = get_int(environment, 'AUTO_BAN_NUMBER_OF_REPEAT_IN_SAME_CHANNEL')
+        self.auto_ban_number_of_different_channel_repeat = get_int(environment, 'AUTO_BAN_NUMBER_OF_DIFFERENT_CHANNEL_REPEAT')
+        self.auto_ban_character_length_minimum = get_int(environment, 'AUTO_BAN_CHARACTER_LENGTH_MINIMUM')
+        self.auto_ban_detection_period_minutes = get_int(environment, 'AUTO_BAN_DETECTION_PERIOD_MINUTES')
+        self.auto_ban_new_user_threshold_seconds = get_int(environment, 'AUTO_BAN_NEW_USER_THRESHOLD_SECONDS')
+        self.auto_ban_near_duplicate_max_distance = get_int(environment, 'AUTO_BAN_NEAR_DUPLICATE_MAX_DISTANCE', 6)
+        self.auto_ban_number_of_distinct_authors_repeat = get_int(environment, 'AUTO_BAN_NUMBER_OF_DISTINCT_AUTHORS_REPEAT', 5)
+        self.auto_ban_cluster_member_max_age_days = get_int(environment, 'AUTO_BAN_CLUSTER_MEMBER_MAX_AGE_DAYS', 7)
+        self.auto_ban_evidence_max_bytes = get_int(environment, 'AUTO_BAN_EVIDENCE_MAX_BYTES', 8 * 1024 * 1024)
+        self.auto_ban_raid_join_threshold = get_int(environment, 'AUTO_BAN_RAID_JOIN_THRESHOLD', 15)
+        self.auto_ban_raid_join_window_seconds = get_int(environment, 'AUTO_BAN_RAID_JOIN_WINDOW_SECONDS', 60)
+        self.member_cache_flags = get_name_set(environment, 'MEMBER_CACHE_FLAGS', ('joined', 'voice'), ('joined',))
+        self.max_messages = get_int(environment, 'MAX_MESSAGES', 0)
+        if self.auto_ban_detection_period_minutes <= 0:
+            raise ValueError('AUTO_BAN_DETECTION_PERIOD_MINUTES must be at least 1')
+        # a message always repeats itself once, so a count below 2 would ban on every qualifying message
+        for name in ('AUTO_BAN_NUMBER_OF_REPEAT_IN_SAME_CHANNEL', 'AUTO_BAN_NUMBER_OF_DIFFERENT_CHANNEL_REPEAT',
+                     'AUTO_BAN_NUMBER_OF_DISTINCT_AUTHORS_REPEAT'):
+            if getattr(self, name.lower()) < 2:
+                raise ValueError(f'{name} must be at least 2')
+        if self.auto_ban_raid_join_window_seconds <= 0:
+            raise ValueError('AUTO_BAN_RAID_JOIN_WINDOW_SECONDS must be at least 1')
+        if self.auto_ban_evidence_max_bytes <= 0:
+            raise ValueError('AUTO_BAN_EVIDENCE_MAX_BYTES must be at least 1')
+        if not 0 <= self.auto_ban_near_duplicate_max_distance < 64:
+            raise ValueError('AUTO_BAN_NEAR_DUPLICATE_MAX_DISTANCE must be between 0 and 63')
+        # 1 would make every join a raid, 0 is how raid detection is turned off
+        if self.auto_ban_raid_join_threshold != 0 and self.auto_ban_raid_join_threshold < 2:
+            raise ValueError('AUTO_BAN_RAID_JOIN_THRESHOLD must be at least 2, or 0 to turn raid detection off')
+        if self.max_messages < 0:
+            raise ValueError('MAX_MESSAGES must be 0 or more')
+
+    def get_changes(self, other: 'Config') -> list:
+        """Names (as environment variables) of the settings that differ between this config and other."""
+        return [name.upper() for name in self.__slots__ if getattr(self, name) != getattr(other, name)]
+
+
+def load_config() -> Config:
+    """
+    Read the configuration from the environment, and from the .env file next to main.py for anything the environment
+    does not set (like load_dotenv, the environment wins). The .env file is read again on every call, so editing it
+    and reloading picks up the change.
+    """
+    environment = dotenv_values(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env'))
+    environment.update(os.environ)
+    return Config(environment)
+
+
+# The configuration the bot started with, parsed once when this module is first imported.
+# Only for what has to be known at import time (slash command guilds and role checks); everything else should read
+# bot.config, which follows reloads.
+STARTUP_CONFIG = load_config()
@@ -0,0 +1,94 @@
+import ast
+import os
+import discord
+
+
+# The gateway intents each event needs, and why. An event is only received if all of its intents are enabled.
+EVENT_INTENTS = {
+    'on_message': {
+        'guild_messages': 'messages sent in the server',
+        'message_content': 'the content, embeds and attachments of messages'},
+    'on_message_edit': {'guild_messages': 'edits of messages sent in the server'},
+    'on_message_delete': {'guild_messages': 'deletions of messages sent in the server'},
+    'on_raw_message_edit': {'guild_messages': 'edits of messages sent in the server'},
+    'on_raw_message_delete': {'guild_messages': 'deletions of messages sent in the server'},
+    'on_member_join': {'members': 'members joining'},
+    'on_member_remove': {'members': 'members leaving'},
+    'on_raw_member_remove': {'members': 'members leaving'},
+    'on_member_update': {'members': 'changes to members (roles, nickname)'},
+    'on_reaction_add': {'guild_reactions': 'reactions added to messages'},
+    'on_reaction_remove': {'guild_reactions': 'reactions removed from messages'},
+    'on_raw_reaction_add': {'guild_reactions': 'reactions added to messages'},
+    'on_raw_reaction_remove': {'guild_reactions': 'reactions removed from messages'},
+    'on_voice_state_update': {'voice_states': 'members joining and leaving voice channels'},
+}
+# Events that come without any intent (connection events, the bot's own events and interactions)
+EVENTS_WITHOUT_INTENTS = (
+    'on_ready', 'on_resumed', 'on_connect', 'on_disconnect', 'on_error', 'on_interaction', 'on_command_error',
+    'on_app_command_completion', 'on_config_reload')
+# The intents needed by the member cache flags
+MEMBER_CACHE_FLAG_INTENTS = {'joined': 'members', 'voice': 'voice_states'}
+
+
+def get_cog_listener_events(cogs_dir: str) -> dict:
+    """
+    Find the events listened to by the cogs, by reading the cog files rather than importing them (the intents have
+    to be known before the bot is made, and the cogs are only loaded after that).
+    Return a dict of event name -> list of the files (relative to cogs_dir) with a listener for it.
+    """
+    listener_events = {}
+    for directory in sorted(os.listdir(cogs_dir)):
+        if not os.path.isdir(os.path.join(cogs_dir, directory)):
+            continue
+        for filename in sorted(os.listdir(os.path.join(cogs_dir, directory))):
+            if not filename.endswith('.py'):
+                continue
+            with open(os.path.join(cogs_dir, directory, filename), 'r', encoding='utf-8') as file:
+                tree = ast.parse(file.read())
+            for node in ast.walk(tree):
+                if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    continue
+                for decorator in node.decorator_list:
+                    # @commands.Cog.listener() or @commands.Cog.listener('on_event')
+                    if not (isinstance(decorator, ast.Call) and isinstance(decorator.func, ast.Attribute)
+                            and decorator.func.attr == 'listener'):
+                        continue
+                    event = node.name
+                    if decorator.args and isinstance(decorator.args[0], ast.Constant):
+                        event = decorator.args[0].value
+                    for keyword in decorator.keywords:
+                        if keyword.arg == 'name' and isinstance(keyword.value, ast.Constant):
+                            event = keyword.value.value
+                    listener_events.setdefault(event, []).append(f'{directory}/{filename}')
+    return listener_events
+
+
+def get_intents(listener_events: dict, member_cache_flags: frozenset) -> tuple:
+    """
+    Work out the intents the cogs need from the events they listen to (see get_cog_listener_events) and the member
+    cache flags. Return the intents, and a dict of intent name -> list of reasons it is enabled.
+    If a cog listens to an event missing from EVENT_INTENTS, its intents are unknown, so every intent is enabled.
+    """
+    reasons = {'guilds': ['the server, its channels and roles (always needed)']}
+    for event, files in sorted(listener_events.items()):
+        if event in EVENTS_WITHOUT_INTENTS:
+            continue
+        if event not in EVENT_INTENTS:
+            return discord.Intents.all(), {'all': [f'{event} in {", ".join(files)} is not in EVENT_INTENTS']}
+        for intent, reason in EVENT_INTENTS[event].items():
+            reasons.setdefault(intent, []).append(f'{event} in {", ".join(files)}: {reason}')
+    for flag in sorted(member_cache_flags):
+        reasons.setdefault(MEMBER_CACHE_FLAG_INTENTS[flag], []).append(f'MEMBER_CACHE_FLAGS includes {flag}')
+    intents = discord.Intents.none()
+    for intent in reasons:
+        setattr(intents, intent, True)
+    return intents, reasons
+
+
+def get_member_cache_flags(member_cache_flags: frozenset) -> discord.MemberCacheFlags:
+    return discord.MemberCacheFlags(**{flag: flag in member_cache_flags for flag in MEMBER_CACHE_FLAG_INTENTS})
+
+
+def get_intents_report(reasons: dict) -> str:
+    """One line per enabled intent, with why it is enabled."""
+    return '\n'.join(f'{intent}: {"; ".join(intent_reasons)}' for intent, intent_reasons in reasons.items())
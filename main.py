@@ -1,35 +1,340 @@
+import time
+# taken before anything else is imported, for the startup profile
+STARTUP_START = time.perf_counter()
 import os
-from dotenv import load_dotenv
 import discord
 from discord.ext import commands
+import asyncio
+import concurrent.futures
+import contextlib
 import datetime
+import gzip
+import hashlib
+import json
+import logging
+import logging.handlers
+import queue
+import shutil
+import signal
+import sys
 
-load_dotenv()
-APPLICATION_ID = int(os.getenv('APPLICATION_ID'))
-DISCORD_BOT_TOKEN = os.getenv('DISCORD_BOT_TOKEN')
-COMMAND_PREFIX = os.getenv('COMMAND_PREFIX')
-SERVER_ID = int(os.getenv('SERVER_ID'))
-LOG_CHANNEL_ID = int(os.getenv('LOG_CHANNEL_ID'))
+
+class StartupProfiler:
+    """
+    Records how long each step of startup took, from the first line of main.py to the end of every cog's on_ready.
+    Steps are always recorded (it costs next to nothing). The report is only made with --profile-startup:
+        python main.py --profile-startup
+    """
+    def __init__(self, start: float):
+        self.start = start
+        self.steps = []
+        self.run_started_at = None
+        self.setup_hook_started_at = None
+        self.setup_hook_finished_at = None
+        self.ready_at = None
+        self.pending_on_ready_count = 0
+        self.reported = False
+
+    def record(self, step: str, seconds: float) -> None:
+        self.steps.append((step, seconds))
+
+    @contextlib.contextmanager
+    def measure(self, step: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(step, time.perf_counter() - start)
+
+    def get_report(self) -> str:
+        lines = [f'{seconds:8.3f}s  {step}' for step, seconds in self.steps]
+        lines.append(f'{time.perf_counter() - self.start:8.3f}s  total, from the first line of main.py')
+        return '\n'.join(lines)
+
+
+STARTUP_PROFILER = StartupProfiler(STARTUP_START)
+STARTUP_PROFILER.record('imports (main.py)', time.perf_counter() - STARTUP_START)
+PROFILE_STARTUP = '--profile-startup' in sys.argv
+
+# the configuration is parsed once, when config is first imported (see config.py)
+with STARTUP_PROFILER.measure('load configuration (config.py)'):
+    from config import Config, RESTART_ONLY_VARIABLES, STARTUP_CONFIG, load_config
+from intents import get_cog_listener_events, get_intents, get_intents_report, get_member_cache_flags
+
+# Logs are sent to the log channel in batches: up to 10 embeds (and 6000 characters) per message, which is all
+# Discord allows, sent as soon as a batch is full or LOG_FLUSH_INTERVAL_SECONDS after its first log.
+LOG_BATCH_MAX_EMBEDS = 10
+LOG_BATCH_MAX_CHARACTERS = 6000
+# Discord rejects a message with an embed field value over EMBED_FIELD_MAX_CHARACTERS, or content over
+# MESSAGE_MAX_CHARACTERS, so longer logs (e.g. the text of a spam message) are cut short to fit
+EMBED_FIELD_MAX_CHARACTERS = 1024
+MESSAGE_MAX_CHARACTERS = 2000
+LOG_FLUSH_INTERVAL_SECONDS = 2
+# Logs waiting to be sent are kept in memory up to LOG_QUEUE_MAX_SIZE, the rest spill to LOG_OVERFLOW_PATH
+LOG_QUEUE_MAX_SIZE = 500
+LOGGING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'logging')
+LOG_OVERFLOW_PATH = os.path.join(LOGGING_DIR, 'log_overflow.jsonl')
+# Every log is also written to LOG_FILE_PATH as a JSON line. The file is rotated at midnight, or once it reaches
+# LOG_FILE_MAX_BYTES, into a gzip compressed file next to it. Rotated files are never deleted.
+LOG_FILE_PATH = os.path.join(LOGGING_DIR, 'bot_log.jsonl')
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+# Hash of the command tree last synced to Discord. Delete the file to force a sync on the next start.
+COMMAND_TREE_HASH_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'command_tree_hash.txt')
+# With --profile-startup, the report of the last start is written here (and sent to the log channel)
+STARTUP_PROFILE_PATH = os.path.join(LOGGING_DIR, 'startup_profile.txt')
+
+
+def shorten(text: str, max_characters: int) -> str:
+    """text, cut short to max_characters (ending in ...) if it is longer."""
+    text = str(text)
+    return text if len(text) <= max_characters else text[:max_characters - 3] + '...'
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format a log record as one JSON object: its time, and the fields Bot.log was called with."""
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {'time': datetime.datetime.fromtimestamp(record.created, tz=datetime.timezone.utc).isoformat()}
+        fields.update(getattr(record, 'log_fields', {}))
+        return json.dumps(fields, ensure_ascii=False)
+
+
+class CompressingRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """
+    Rotate the log file at midnight, and whenever it would grow past max_bytes, gzip compressing the rotated file.
+    A file rotated for its size is named after the day like any other, with a counter to keep the names apart.
+    """
+    def __init__(self, filename: str, max_bytes: int):
+        super().__init__(filename, when='midnight', encoding='utf-8', utc=True)
+        self.max_bytes = max_bytes
+        self.namer = self.get_compressed_name
+        self.rotator = self.compress
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if super().shouldRollover(record):
+            return True
+        if self.stream is None:
+            self.stream = self._open()
+        self.stream.seek(0, 2)
+        return self.stream.tell() + len(self.format(record)) + 1 > self.max_bytes
+
+    @staticmethod
+    def get_compressed_name(default_name: str) -> str:
+        name = f'{default_name}.gz'
+        counter = 1
+        while os.path.exists(name):
+            name = f'{default_name}.{counter}.gz'
+            counter += 1
+        return name
+
+    @staticmethod
+    def compress(source: str, destination: str) -> None:
+        with open(source, 'rb') as source_file, gzip.open(destination, 'wb') as destination_file:
+            shutil.copyfileobj(source_file, destination_file)
+        os.remove(source)
+
+
+def get_spilled_log_line(log) -> str:
+    """The line a log (an embed or plain message) is kept as in LOG_OVERFLOW_PATH."""
+    record = {'embed': log.to_dict()} if isinstance(log, discord.Embed) else {'content': log}
+    return json.dumps(record) + '\n'
+
+
+def append_spilled_logs(lines: list) -> None:
+    """Append lines (see get_spilled_log_line) to LOG_OVERFLOW_PATH. Blocking, run on the log spill thread."""
+    os.makedirs(os.path.dirname(LOG_OVERFLOW_PATH), exist_ok=True)
+    with open(LOG_OVERFLOW_PATH, 'a') as file:
+        file.writelines(lines)
+
+
+def prepend_spilled_logs(lines: list) -> None:
+    """Put lines before the ones already in LOG_OVERFLOW_PATH. Blocking, run on the log spill thread."""
+    spilled_lines = []
+    if os.path.isfile(LOG_OVERFLOW_PATH):
+        with open(LOG_OVERFLOW_PATH, 'r') as file:
+            spilled_lines = file.readlines()
+    os.makedirs(os.path.dirname(LOG_OVERFLOW_PATH), exist_ok=True)
+    with open(LOG_OVERFLOW_PATH, 'w') as file:
+        file.writelines(lines + spilled_lines)
+
+
+def take_spilled_logs(count: int) -> tuple:
+    """
+    Remove up to count logs from the start of LOG_OVERFLOW_PATH. Return the records taken, oldest first, and whether
+    the file is now empty (and removed). Blocking, run on the log spill thread.
+    """
+    if not os.path.isfile(LOG_OVERFLOW_PATH):
+        return [], True
+    with open(LOG_OVERFLOW_PATH, 'r') as file:
+        lines = file.readlines()
+    records = []
+    for line in lines[:count]:
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            # the last line may be cut short if the bot died while writing it
+            continue
+    if len(lines) > count:
+        with open(LOG_OVERFLOW_PATH, 'w') as file:
+            file.writelines(lines[count:])
+        return records, False
+    os.remove(LOG_OVERFLOW_PATH)
+    return records, True
 
 
 class Bot(commands.Bot):
-    def __init__(self):
+    def __init__(self, config: Config):
+        # only the intents the cogs' listeners need, so Discord does not send (and we do not cache) anything else
+        intents, self.intent_reasons = get_intents(
+            get_cog_listener_events(os.path.join(os.path.dirname(__file__), 'cogs')), config.member_cache_flags)
         super().__init__(
-            command_prefix=COMMAND_PREFIX,
-            intents=discord.Intents.all(),
-            application_id=APPLICATION_ID)
+            command_prefix=config.command_prefix,
+            intents=intents,
+            member_cache_flags=get_member_cache_flags(config.member_cache_flags),
+            # no cog uses cached messages (edits, deletions or reactions of cached messages), so 0 turns the cache off
+            max_messages=config.max_messages if config.max_messages > 0 else None,
+            application_id=config.application_id)
+        # swapped for a new Config by reload_config, cogs should read it when they need a value rather than keep it
+        self.config = config
+        self.log_queue = None
+        self.log_sink_task = None
+        # the logs run_log_sink is sending right now, kept on disk by close if they could not be sent
+        self.log_batch = []
+        # once logs spill to disk, every log goes there until the file is sent, so logs stay in order
+        self.log_spilling = os.path.isfile(LOG_OVERFLOW_PATH)
+        # LOG_OVERFLOW_PATH is only read and written on this one thread, off the event loop and in the order asked
+        self.log_spill_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='log_spill')
+        # counts spills, for load_spilled_logs to tell whether logs were spilled while it read the file
+        self.log_spill_count = 0
+        self.logs_closed = False
+        # log() only puts the record on a queue, the listener's thread formats it and writes the file
+        os.makedirs(LOGGING_DIR, exist_ok=True)
+        file_handler = CompressingRotatingFileHandler(LOG_FILE_PATH, LOG_FILE_MAX_BYTES)
+        file_handler.setFormatter(JsonLinesFormatter())
+        file_log_queue = queue.SimpleQueue()
+        self.file_logger = logging.getLogger('bot_log')
+        self.file_logger.setLevel(logging.INFO)
+        self.file_logger.propagate = False
+        self.file_logger.addHandler(logging.handlers.QueueHandler(file_log_queue))
+        self.file_log_listener = logging.handlers.QueueListener(file_log_queue, file_handler)
+        self.file_log_listener.start()
+        # filled in by setup_hook, reported in the ready log
+        self.extension_load_seconds = {}
+        self.command_tree_sync_outcome = None
+        self.startup_profiler = STARTUP_PROFILER
 
     async def setup_hook(self):
+        self.startup_profiler.setup_hook_started_at = time.perf_counter()
+        self.startup_profiler.record(
+            'login (bot.run to setup_hook)', self.startup_profiler.setup_hook_started_at - self.startup_profiler.run_started_at)
+        self.log_queue = asyncio.Queue(maxsize=LOG_QUEUE_MAX_SIZE)
+        self.log_sink_task = asyncio.create_task(self.run_log_sink())
+        # kill -HUP <pid> reloads the configuration, kill <pid> (SIGTERM, e.g. systemctl stop) closes the bot
+        # cleanly, keeping unsent logs and letting the cogs save their state (there are no signal handlers on Windows)
+        if hasattr(signal, 'SIGHUP'):
+            loop = asyncio.get_running_loop()
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(self.reload_config()))
+            loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
         # directory is cogs/directory_name/filename.py
         dirname = os.path.dirname(__file__)
+        extensions = []
         for directory in os.listdir(os.path.join(dirname, 'cogs')):
             if os.path.isdir(os.path.join(dirname, 'cogs', directory)):
                 for filename in os.listdir(os.path.join(dirname, 'cogs', directory)):
                     if filename.endswith('.py'):
-                        await self.load_extension(f'cogs.{directory}.{filename[:-3]}')
-        await bot.tree.sync(guild=discord.Object(id=SERVER_ID))
+                        extensions.append(f'cogs.{directory}.{filename[:-3]}')
+        # cogs do not depend on each other, so their setup (which may wait on Discord) can overlap
+        await asyncio.gather(*[self.load_extension_timed(extension) for extension in sorted(extensions)])
+        await self.sync_command_tree_if_changed()
+        self.startup_profiler.setup_hook_finished_at = time.perf_counter()
+        self.startup_profiler.record(
+            'setup_hook (cogs load concurrently, so their times overlap)',
+            self.startup_profiler.setup_hook_finished_at - self.startup_profiler.setup_hook_started_at)
+        if PROFILE_STARTUP:
+            self.profile_cog_on_ready()
+
+    async def load_extension_timed(self, extension: str) -> None:
+        start = time.perf_counter()
+        await self.load_extension(extension)
+        self.extension_load_seconds[extension] = time.perf_counter() - start
+        self.startup_profiler.record(f'load_extension {extension}', self.extension_load_seconds[extension])
+
+    def profile_cog_on_ready(self) -> None:
+        """Time the first run of every cog's on_ready, and report the profile once they have all finished."""
+        listeners = self.extra_events.get('on_ready', [])
+        self.startup_profiler.pending_on_ready_count = len(listeners)
+        for i, listener in enumerate(listeners):
+            listeners[i] = self.get_profiled_on_ready(listener)
+
+    def get_profiled_on_ready(self, listener):
+        cog_name = type(getattr(listener, '__self__', None)).__name__
+        first_run = True
+
+        async def profiled_on_ready(*args, **kwargs):
+            nonlocal first_run
+            if not first_run:
+                return await listener(*args, **kwargs)
+            first_run = False
+            start = time.perf_counter()
+            try:
+                return await listener(*args, **kwargs)
+            finally:
+                self.startup_profiler.record(f'on_ready {cog_name}', time.perf_counter() - start)
+                self.startup_profiler.pending_on_ready_count -= 1
+                self.report_startup_profile()
+        return profiled_on_ready
+
+    def report_startup_profile(self) -> None:
+        """Once ready and every cog's on_ready finished, write the profile to STARTUP_PROFILE_PATH and the log channel."""
+        profiler = self.startup_profiler
+        if not PROFILE_STARTUP or profiler.reported or profiler.ready_at is None or profiler.pending_on_ready_count > 0:
+            return
+        profiler.reported = True
+        report = profiler.get_report()
+        os.makedirs(os.path.dirname(STARTUP_PROFILE_PATH), exist_ok=True)
+        with open(STARTUP_PROFILE_PATH, 'w') as file:
+            file.write(f'{datetime.datetime.now()}\n{report}\n')
+        embed = discord.Embed()
+        embed.title = 'Startup profile'
+        embed.timestamp = datetime.datetime.now()
+        embed.description = f'```\n{report[:4000]}\n```'
+        self.queue_log(embed)
+        self.file_logger.info('Startup profile', extra={'log_fields': {'event': 'Startup profile', 'outcome': report}})
+        print(f'{datetime.datetime.now()}\n\t Startup profile:\n\t ' + report.replace('\n', '\n\t '))
+
+    def get_command_tree_hash(self) -> str:
+        """Hash of the commands as they would be sent to Discord, to tell whether they changed since the last sync."""
+        guild = discord.Object(id=self.config.server_id)
+        # sorted, since the order cogs finish loading in (and so add their commands in) can change between starts
+        commands_payload = sorted(
+            [command.to_dict(self.tree) for command in self.tree.get_commands(guild=guild)],
+            key=lambda command: (command.get('type', 1), command['name']))
+        payload = json.dumps({'application_id': self.config.application_id, 'server_id': self.config.server_id, 'commands': commands_payload}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    async def sync_command_tree_if_changed(self) -> None:
+        """
+        Syncing the command tree is a slow, heavily rate limited request, and is only needed when the commands changed.
+        Sync when the hash of the tree differs from the one saved at the last sync, then save the new hash.
+        """
+        tree_hash = self.get_command_tree_hash()
+        if os.path.isfile(COMMAND_TREE_HASH_PATH):
+            with open(COMMAND_TREE_HASH_PATH, 'r') as file:
+                if file.read().strip() == tree_hash:
+                    self.command_tree_sync_outcome = 'Command tree unchanged, sync skipped.'
+                    return
+        start = time.perf_counter()
+        await self.tree.sync(guild=discord.Object(id=self.config.server_id))
+        self.startup_profiler.record('tree.sync', time.perf_counter() - start)
+        os.makedirs(os.path.dirname(COMMAND_TREE_HASH_PATH), exist_ok=True)
+        with open(COMMAND_TREE_HASH_PATH, 'w') as file:
+            file.write(tree_hash)
+        self.command_tree_sync_outcome = f'Command tree synced in {time.perf_counter() - start:.2f}s.'
 
     async def on_ready(self):
+        profiler = self.startup_profiler
+        if profiler.ready_at is None:
+            profiler.ready_at = time.perf_counter()
+            profiler.record('gateway connect (end of setup_hook to ready)', profiler.ready_at - profiler.setup_hook_finished_at)
         log_message = str(datetime.datetime.now())
         embed = discord.Embed()
         embed.title = f'{self.user.name}{("#" + self.user.discriminator) if len(self.user.discriminator) > 1 else ""} (ID: {self.user.id})'
@@ -38,8 +343,19 @@ class Bot(commands.Bot):
         embed.set_author(name=self.user.name, icon_url=self.user.avatar.url if self.user.avatar is not None else self.user.default_avatar.url)
         embed.description = 'Bot is ready.'
         log_message += '\n\t Bot is ready.'
-        await self.get_channel(LOG_CHANNEL_ID).send(embed=embed)
+        startup_report = '\n'.join(
+            [f'{extension}: loaded in {seconds:.2f}s' for extension, seconds in sorted(self.extension_load_seconds.items())]
+            + ([self.command_tree_sync_outcome] if self.command_tree_sync_outcome is not None else []))
+        if startup_report:
+            embed.add_field(name='Startup: ', value=startup_report[:1024], inline=False)
+            log_message += '\n\t ' + startup_report.replace('\n', '\n\t ')
+        intents_report = get_intents_report(self.intent_reasons)
+        embed.add_field(name='Intents: ', value=intents_report[:1024], inline=False)
+        log_message += '\n\t Intents:\n\t ' + intents_report.replace('\n', '\n\t ')
+        self.queue_log(embed)
+        self.file_logger.info('Bot is ready.', extra={'log_fields': {'event': 'Bot is ready.', 'outcome': startup_report, 'intents': self.intent_reasons}})
         print(log_message)
+        self.report_startup_profile()
 
     async def log(
             self,
@@ -51,6 +367,8 @@ class Bot(commands.Bot):
             outcome: str = None) -> None:
         """
         Logs an event to the log channel and prints it to the console.
+        Returns right away: the log is printed now, and queued to be sent to the log channel by run_log_sink.
+        It is also written to LOG_FILE_PATH, as JSON with the ids and names of the user and channel, by a background thread.
 
         :param cog: the cog that called this function
         :param user: the user that triggered the event
@@ -60,6 +378,15 @@ class Bot(commands.Bot):
         :param outcome: the outcome of the event (only used for user actions or errors)
         :return: None
         """
+        self.file_logger.info(event, extra={'log_fields': {
+            'cog': type(cog).__name__,
+            'user_id': getattr(user, 'id', None),
+            'user_name': getattr(user, 'name', None),
+            'user_action': user_action,
+            'channel_id': getattr(channel, 'id', None),
+            'channel_name': getattr(channel, 'name', None),
+            'event': event,
+            'outcome': outcome}})
         try:
             log_message = str(datetime.datetime.now())
             embed = discord.Embed()
@@ -71,18 +398,18 @@ class Bot(commands.Bot):
                 embed.set_footer(text=f'{user.name}{("#"+user.discriminator) if len(user.discriminator) > 1 else ""} ({user.id})', icon_url=user.avatar.url if user.avatar is not None else user.default_avatar.url)
                 log_message += f'\n\t User: {user.name}{("#"+user.discriminator) if len(user.discriminator) > 1 else ""} ({user.id})'
             if user_action is not None:
-                embed.add_field(name='User Action: ', value=user_action, inline=False)
+                embed.add_field(name='User Action: ', value=shorten(user_action, EMBED_FIELD_MAX_CHARACTERS), inline=False)
                 log_message += f'\n\t User Action: {user_action}'
             if channel is not None:
                 embed.add_field(name='In Channel: ', value=f'{channel.mention} ({channel.id})', inline=False)
                 log_message += f'\n\t In Channel: {channel.name} ({channel.id})'
             if event is not None:
-                embed.add_field(name='Event: ', value=event, inline=False)
+                embed.add_field(name='Event: ', value=shorten(event, EMBED_FIELD_MAX_CHARACTERS), inline=False)
                 log_message += f'\n\t Event: {event}'
             if outcome is not None:
-                embed.add_field(name='Outcome: ', value=outcome, inline=False)
+                embed.add_field(name='Outcome: ', value=shorten(outcome, EMBED_FIELD_MAX_CHARACTERS), inline=False)
                 log_message += f'\n\t Outcome: {outcome}'
-            await self.get_channel(LOG_CHANNEL_ID).send(embed=embed)
+            self.queue_log(embed)
             print(log_message)
         except Exception as e:
             log_message = str(datetime.datetime.now())
@@ -94,8 +421,166 @@ class Bot(commands.Bot):
             log_message += f'\n\t event: {event}'
             log_message += f'\n\t outcome: {outcome}'
             print(log_message)
-            await self.get_channel(LOG_CHANNEL_ID).send(log_message)
+            self.queue_log(log_message)
+
+    def queue_log(self, log) -> None:
+        """Queue an embed (or plain message) for the log channel. Never blocks: if the queue is full, spill to disk."""
+        if isinstance(log, str):
+            log = shorten(log, MESSAGE_MAX_CHARACTERS)
+        if self.log_queue is None or self.log_spilling or self.log_queue.full() or self.logs_closed:
+            self.spill_logs([log])
+        else:
+            self.log_queue.put_nowait(log)
+
+    def spill_logs(self, logs: list) -> None:
+        """
+        Append logs to LOG_OVERFLOW_PATH, to be sent once the queue has room again.
+        Returns right away, the file is written on the log spill thread.
+        """
+        self.log_spilling = True
+        self.log_spill_count += 1
+        lines = [get_spilled_log_line(log) for log in logs]
+        if self.log_spill_executor is None:
+            # logged after close stopped the log spill thread
+            append_spilled_logs(lines)
+        else:
+            self.log_spill_executor.submit(append_spilled_logs, lines)
+
+    async def load_spilled_logs(self) -> None:
+        """Move as many spilled logs as fit back into the queue, oldest first."""
+        room = LOG_QUEUE_MAX_SIZE - self.log_queue.qsize()
+        spill_count = self.log_spill_count
+        records, emptied = await asyncio.get_running_loop().run_in_executor(self.log_spill_executor, take_spilled_logs, room)
+        for record in records:
+            self.log_queue.put_nowait(discord.Embed.from_dict(record['embed']) if 'embed' in record else record['content'])
+        # logs spilled while the file was read are written after it was removed, and still have to be loaded
+        if emptied and self.log_spill_count == spill_count:
+            self.log_spilling = False
+
+    async def run_log_sink(self) -> None:
+        """
+        Send queued logs to the log channel, batching as many as one message can hold.
+        Only this task sends logs, so a burst of logs waits here (discord.py waits out the rate limit) instead of
+        holding up whoever logged them.
+        """
+        await self.wait_until_ready()
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.log_spilling and self.log_queue.empty():
+                await self.load_spilled_logs()
+            batch = [await self.log_queue.get()]
+            deadline = loop.time() + LOG_FLUSH_INTERVAL_SECONDS
+            while len(batch) < LOG_BATCH_MAX_EMBEDS:
+                try:
+                    batch.append(await asyncio.wait_for(self.log_queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            self.log_batch = batch
+            try:
+                await self.send_logs(batch)
+            except Exception as e:
+                if self.is_closed():
+                    # the connection was closed under us, close keeps the batch on disk
+                    return
+                print(f'{datetime.datetime.now()}\n\t Error: failed to send {len(batch)} log(s) to the log channel: {e}')
+            self.log_batch = []
+
+    async def send_logs(self, logs: list) -> None:
+        """Send the logs in as few messages as possible. Plain messages are sent on their own."""
+        log_channel = self.get_channel(self.config.log_channel_id)
+        embeds = []
+        for log in logs:
+            if isinstance(log, str):
+                if embeds:
+                    await self.send_log_embeds(log_channel, embeds)
+                    embeds = []
+                await log_channel.send(log)
+                continue
+            if embeds and sum(len(embed) for embed in embeds) + len(log) > LOG_BATCH_MAX_CHARACTERS:
+                await self.send_log_embeds(log_channel, embeds)
+                embeds = []
+            embeds.append(log)
+        if embeds:
+            await self.send_log_embeds(log_channel, embeds)
+
+    @staticmethod
+    async def send_log_embeds(log_channel: discord.TextChannel, embeds: list) -> None:
+        """
+        Send the embeds in one message. Discord rejects the whole message if one embed is invalid, so if it does,
+        send them one at a time instead, to only lose the invalid one.
+        """
+        if len(embeds) > 1:
+            try:
+                await log_channel.send(embeds=embeds)
+                return
+            except discord.HTTPException:
+                pass
+        for embed in embeds:
+            try:
+                await log_channel.send(embed=embed)
+            except discord.HTTPException as e:
+                print(f'{datetime.datetime.now()}\n\t Error: failed to send a {embed.title} log to the log channel: {e}')
+
+    async def reload_config(self) -> None:
+        """
+        Read the configuration again and swap it in as self.config. Cogs keeping anything worked out from the old
+        configuration update it in an on_config_reload(before, after) listener.
+        Variables in RESTART_ONLY_VARIABLES keep their old values until a restart. If the new configuration is
+        invalid, the old one is kept as a whole.
+        """
+        try:
+            config = load_config()
+        except ValueError as e:
+            await self.log(
+                cog=self,
+                event='Failed to reload the configuration, keeping the old one.',
+                outcome=f'Error: {e}')
+            return
+        changes = self.config.get_changes(config)
+        restart_only_changes = [name for name in changes if name in RESTART_ONLY_VARIABLES]
+        # config is not shared yet, so it can still be changed
+        for name in restart_only_changes:
+            setattr(config, name.lower(), getattr(self.config, name.lower()))
+        before, self.config = self.config, config
+        self.command_prefix = config.command_prefix
+        self.dispatch('config_reload', before, config)
+        outcome = f'Changed: {", ".join(changes)}.' if changes else 'Nothing changed.'
+        if restart_only_changes:
+            outcome += f' {", ".join(restart_only_changes)} will only change after a restart.'
+        await self.log(
+            cog=self,
+            event='Configuration reloaded.',
+            outcome=outcome)
+
+    async def close(self) -> None:
+        """
+        Close the bot first (the cogs unload, and may log while they do), then keep the logs that were not sent yet
+        on disk, they are sent after the next start. The log file is written up to the last log.
+        """
+        await super().close()
+        # close may be called again, e.g. by bot.run after a SIGTERM, the logs are only put away once
+        if self.logs_closed:
+            return
+        self.logs_closed = True
+        if self.log_sink_task is not None:
+            self.log_sink_task.cancel()
+            # the batch being sent (if the connection closed while it was) and the queued logs are older than the
+            # ones still on disk
+            unsent_logs = self.log_batch
+            while not self.log_queue.empty():
+                unsent_logs.append(self.log_queue.get_nowait())
+            if unsent_logs:
+                await asyncio.get_running_loop().run_in_executor(
+                    self.log_spill_executor, prepend_spilled_logs, [get_spilled_log_line(log) for log in unsent_logs])
+        # wait for the spills still being written, later spills are written right away (see spill_logs)
+        await asyncio.get_running_loop().run_in_executor(self.log_spill_executor, lambda: None)
+        self.log_spill_executor.shutdown(wait=False)
+        self.log_spill_executor = None
+        # writes whatever is still queued for the log file
+        await asyncio.to_thread(self.file_log_listener.stop)
 
 
-bot = Bot()
-bot.run(DISCORD_BOT_TOKEN)
\ No newline at end of file
+with STARTUP_PROFILER.measure('Bot()'):
+    bot = Bot(STARTUP_CONFIG)
+STARTUP_PROFILER.run_started_at = time.perf_counter()
+bot.run(STARTUP_CONFIG.discord_bot_token)
\ No newline at end of file
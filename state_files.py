@@ -0,0 +1,126 @@
+import asyncio
+import datetime
+import os
+
+
+def write_file_atomically(path: str, data: str) -> None:
+    """
+    Replace the file at path with data at once: write it to a temporary file, fsync it, then rename it over path, so
+    the file is never left half written. Blocking.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path)
+
+
+def append_to_file(path: str, data: str) -> None:
+    """Append data to the file at path, and fsync it. Blocking."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def print_write_error(description: str, error: OSError) -> None:
+    # the bot keeps running on a full or failing disk: what failed to be written is still complete in memory, and is
+    # written again with the next change
+    print(f'{datetime.datetime.now()}\n\t Error: failed to write {description}: {error}')
+
+
+class QueuedFileWriter:
+    """
+    Writes the (kind, data) items queued with put, in order, on a writer task. write_items(items) does the writing,
+    through asyncio.to_thread, so the event loop never waits on disk. Everything queued while a write runs is written
+    together in the next one, so a burst of items costs a single fsync.
+    """
+    def __init__(self, write_items, description: str):
+        self.write_items = write_items
+        # what is written, for error messages
+        self.description = description
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def put(self, kind: str, data) -> None:
+        """Queue an item. Never blocks, and may be called before start."""
+        self.queue.put_nowait((kind, data))
+
+    def is_started(self) -> bool:
+        return self.task is not None
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def close(self) -> None:
+        """Write everything still queued, then stop the writer."""
+        if self.task is None:
+            return
+        self.queue.put_nowait(('close', None))
+        await self.task
+        self.task = None
+
+    async def run(self) -> None:
+        while True:
+            items = [await self.queue.get()]
+            while not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            try:
+                await asyncio.to_thread(self.write_items, [item for item in items if item[0] != 'close'])
+            except OSError as e:
+                print_write_error(self.description, e)
+            if any(kind == 'close' for kind, _ in items):
+                return
+
+
+class FileSaver:
+    """
+    Saves a whole file again after every change (see mark_changed), on a saver task, at most every interval_seconds.
+    get_data() is called on the event loop, so what is saved is never read by the saving thread while it changes, and
+    save(data) writes it, through asyncio.to_thread. Changes made while a save runs are saved together in the next one.
+    """
+    def __init__(self, get_data, save, description: str, interval_seconds: float = 0):
+        self.get_data = get_data
+        self.save = save
+        # what is saved, for error messages
+        self.description = description
+        self.interval_seconds = interval_seconds
+        self.changed = asyncio.Event()
+        self.task = None
+        # the save being written by the saver task, if any
+        self.saving = None
+
+    def mark_changed(self) -> None:
+        """Save again soon. Never blocks, and may be called before start."""
+        self.changed.set()
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def close(self) -> None:
+        """Stop the saver and save one last time, if it was started."""
+        if self.task is None:
+            return
+        self.task.cancel()
+        self.task = None
+        # cancelling the saver does not stop a save already running in its thread, let it finish first
+        if self.saving is not None:
+            await asyncio.wait([self.saving])
+        await asyncio.to_thread(self.save, self.get_data())
+
+    async def run(self) -> None:
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            try:
+                # shielded, so close can wait for the save to finish rather than write the same file at the same time
+                self.saving = asyncio.ensure_future(asyncio.to_thread(self.save, self.get_data()))
+                await asyncio.shield(self.saving)
+            except OSError as e:
+                print_write_error(self.description, e)
+            await asyncio.sleep(self.interval_seconds)
@@ -0,0 +1,407 @@
+"""
+Offline replay harness and benchmark for AutoBanningCog's ban decisions.
+
+Feeds a message stream through AutoBanningCog.on_message with stub guild, member, channel and message objects, and
+reports messages per second, p50/p99 latency per message, and peak memory. The ban decisions (which users were
+queued for which ban, on which message) are compared against a golden file, so threshold tuning and rewrites of the
+detection logic can be checked without a live server.
+
+Usage (from the repository root):
+    python tools/auto_ban_replay.py                      # synthetic stream, checked against the golden file
+    python tools/auto_ban_replay.py --update-golden      # accept the current decisions as the golden file
+    python tools/auto_ban_replay.py --stream FILE        # replay a recorded stream (no golden check unless --golden)
+    python tools/auto_ban_replay.py --write-stream FILE  # save the synthetic stream, to edit or replay later
+
+A stream is a JSON lines file, one message per line, in the order they were sent:
+    {"timestamp": <UNIX TIMESTAMP>, "author_id": <USER_ID>, "channel_id": <CHANNEL_ID>, "content": "<CONTENT>", "joined_at": <UNIX TIMESTAMP>, "role_ids": [<ROLE_ID>, ...]}
+role_ids is optional. Attachments are not replayed: fingerprinting them needs the real CDN.
+
+The environment variables are set to REPLAY_ENVIRONMENT (the golden file was recorded with these), unless
+--use-env is given, in which case the ones already set (or in .env) are used and there is no golden check.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPOSITORY_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+GOLDEN_PATH = os.path.join(REPOSITORY_DIR, 'tools', 'auto_ban_replay_golden.json')
+
+REPLAY_SERVER_ID = 1
+REPLAY_LOG_CHANNEL_ID = 2
+REPLAY_BANNED_ROLE_ID = 3
+REPLAY_ADMINISTRATION_ROLE_ID = 4
+REPLAY_REASON_OF_BAN_CHANNEL_ID = 5
+REPLAY_BOT_USER_ID = 6
+REPLAY_ENVIRONMENT = {
+    'APPLICATION_ID': '1',
+    'DISCORD_BOT_TOKEN': 'replay',
+    'COMMAND_PREFIX': '!',
+    'SERVER_ID': str(REPLAY_SERVER_ID),
+    'LOG_CHANNEL_ID': str(REPLAY_LOG_CHANNEL_ID),
+    'BANNED_ROLE_ID': str(REPLAY_BANNED_ROLE_ID),
+    'ADMINISTRATION_ROLES_IDS': str(REPLAY_ADMINISTRATION_ROLE_ID),
+    'REASON_OF_BAN_CHANNEL_ID': str(REPLAY_REASON_OF_BAN_CHANNEL_ID),
+    'DO_NOT_RE_GIVE_ROLES_IDS': '',
+    'AUTO_BAN_NUMBER_OF_REPEAT_IN_SAME_CHANNEL': '4',
+    'AUTO_BAN_NUMBER_OF_DIFFERENT_CHANNEL_REPEAT': '3',
+    'AUTO_BAN_CHARACTER_LENGTH_MINIMUM': '20',
+    'AUTO_BAN_DETECTION_PERIOD_MINUTES': '5',
+    'AUTO_BAN_NEW_USER_THRESHOLD_SECONDS': '60',
+    'AUTO_BAN_NEAR_DUPLICATE_MAX_DISTANCE': '6',
+    'AUTO_BAN_NUMBER_OF_DISTINCT_AUTHORS_REPEAT': '5',
+    'AUTO_BAN_CLUSTER_MEMBER_MAX_AGE_DAYS': '7',
+    'AUTO_BAN_RAID_JOIN_THRESHOLD': '15',
+    'AUTO_BAN_RAID_JOIN_WINDOW_SECONDS': '60',
+}
+
+# Synthetic streams start at a fixed time, so the same seed always gives the same stream
+SYNTHETIC_START_TIMESTAMP = 1700000000
+SYNTHETIC_VOCABULARY = (
+    'the a to and of in is it that for on you this with be are have was not but at so what just can like do if '
+    'about my me we all one get know think lecture exam midterm problem set assignment lab tutorial due tomorrow '
+    'tonight anyone help question answer course prof notes quiz office hours week thanks lol yeah true wait did '
+    'calculus physics linear algebra circuits chem design project group meeting room library food coffee sleep').split()
+SYNTHETIC_SPAM_TEMPLATES = (
+    'Free Discord Nitro for everyone, claim yours before it runs out: https://disc0rd-gift.com/claim?id={}',
+    'I am giving away my old gaming PC and monitors, message me quickly if you want them {}',
+    'Hot crypto signal group, 500% gains guaranteed every single week, join now https://t.me/pump{}',
+    'Selling verified accounts cheap, all regions available, DM me for the price list today {}',
+)
+# Long replies that many regular members post at once, which must not get them banned
+SYNTHETIC_ORDINARY_REPLIES = (
+    'happy birthday!! hope you have a great day',
+    'congrats on the internship, well deserved',
+    'good luck on the midterm everyone, you got this',
+    'thank you so much for posting the notes',
+)
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Replay a message stream through AutoBanningCog and benchmark it.')
+    parser.add_argument('--stream', help='JSON lines stream to replay, instead of a synthetic one')
+    parser.add_argument('--write-stream', help='write the stream that is replayed to this file')
+    parser.add_argument('--messages', type=int, default=20000, help='number of synthetic messages (default 20000)')
+    parser.add_argument('--authors', type=int, default=500, help='number of synthetic regular authors (default 500)')
+    parser.add_argument('--channels', type=int, default=20, help='number of synthetic channels (default 20)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic stream (default 0)')
+    parser.add_argument('--golden', help='golden file to check the decisions against (default: the synthetic one)')
+    parser.add_argument('--update-golden', action='store_true', help='write the decisions to the golden file')
+    parser.add_argument('--use-env', action='store_true', help='use the environment variables already set')
+    return parser.parse_args()
+
+
+def generate_synthetic_stream(message_count: int, author_count: int, channel_count: int, seed: int) -> list:
+    """
+    Regular chatter from author_count authors over channel_count channels, with spam mixed in:
+    repeats in one channel, repeats across channels, near-duplicates from a group of accounts, and links from
+    accounts that just joined. Regular authors also repeat short messages now and then, share several different links
+    to the same site, and several of them reply with (variants of) the same long message, none of which must get them
+    banned.
+    """
+    rng = random.Random(seed)
+    channel_ids = [1000 + i for i in range(channel_count)]
+    author_ids = [10000 + i for i in range(author_count)]
+    joined_at = {author_id: SYNTHETIC_START_TIMESTAMP - rng.randint(86400, 86400 * 365) for author_id in author_ids}
+    next_author_id = 10000 + author_count
+    timestamp = float(SYNTHETIC_START_TIMESTAMP)
+    stream = []
+
+    def add(author_id: int, channel_id: int, content: str) -> None:
+        stream.append({
+            'timestamp': round(timestamp, 3),
+            'author_id': author_id,
+            'channel_id': channel_id,
+            'content': content,
+            'joined_at': joined_at[author_id]})
+
+    def new_author(joined_seconds_ago: int) -> int:
+        nonlocal next_author_id
+        author_id = next_author_id
+        next_author_id += 1
+        joined_at[author_id] = int(timestamp) - joined_seconds_ago
+        return author_id
+
+    while len(stream) < message_count:
+        timestamp += rng.expovariate(2.0)
+        roll = rng.random()
+        if roll < 0.003:
+            # repeats in one channel
+            author_id = new_author(rng.randint(3600, 86400 * 30))
+            channel_id = rng.choice(channel_ids)
+            content = rng.choice(SYNTHETIC_SPAM_TEMPLATES).format(author_id)
+            for _ in range(rng.randint(3, 6)):
+                timestamp += rng.uniform(0.5, 5)
+                add(author_id, channel_id, content)
+        elif roll < 0.006:
+            # repeats across channels
+            author_id = new_author(rng.randint(3600, 86400 * 30))
+            content = rng.choice(SYNTHETIC_SPAM_TEMPLATES).format(author_id)
+            for channel_id in rng.sample(channel_ids, rng.randint(2, 5)):
+                timestamp += rng.uniform(0.2, 2)
+                add(author_id, channel_id, content)
+        elif roll < 0.007:
+            # a group of new accounts posting near-duplicates of the same message
+            content = rng.choice(SYNTHETIC_SPAM_TEMPLATES).format(rng.randint(0, 10 ** 6))
+            for _ in range(rng.randint(4, 8)):
+                author_id = new_author(rng.randint(3600, 86400 * 3))
+                timestamp += rng.uniform(0.2, 3)
+                add(author_id, rng.choice(channel_ids), content + rng.choice(('', '!', ' !!', ' 🔥', '...')))
+        elif roll < 0.009:
+            # a link right after joining
+            author_id = new_author(rng.randint(1, 120))
+            add(author_id, rng.choice(channel_ids), f'check this out https://example{author_id}.com/page')
+        elif roll < 0.011:
+            # regular authors all replying with (variants of) the same long message
+            content = rng.choice(SYNTHETIC_ORDINARY_REPLIES)
+            channel_id = rng.choice(channel_ids)
+            for author_id in rng.sample(author_ids, rng.randint(5, 8)):
+                timestamp += rng.uniform(1, 20)
+                add(author_id, channel_id, content + rng.choice(('', '!', '!!', ' 🎉', ' :)')))
+        elif roll < 0.012:
+            # a regular author sharing different videos in one channel, with tracking parameters on some
+            author_id = rng.choice(author_ids)
+            channel_id = rng.choice(channel_ids)
+            for _ in range(rng.randint(3, 5)):
+                timestamp += rng.uniform(5, 30)
+                video_id = ''.join(rng.choices('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=11))
+                add(author_id, channel_id, f'https://www.youtube.com/watch?v={video_id}' + rng.choice(('', '&si=share', '&utm_source=app')))
+        elif roll < 0.05:
+            # a regular author repeating something short
+            add(rng.choice(author_ids), rng.choice(channel_ids), rng.choice(('lol', 'yeah', 'same', 'thanks!', 'ok')))
+        else:
+            words = rng.choices(SYNTHETIC_VOCABULARY, k=rng.randint(2, 30))
+            add(rng.choice(author_ids), rng.choice(channel_ids), ' '.join(words))
+    return stream[:message_count]
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+async def replay(auto_banning, stream: list, measure_memory: bool) -> dict:
+    """
+    Feed the stream through a fresh AutoBanningCog. The clock the cog sees is the timestamp of the message being
+    replayed. Return the decisions in order, the latency of every message in seconds, and the peak memory in bytes
+    (None unless measure_memory).
+    """
+    import discord
+    from config import STARTUP_CONFIG
+
+    class ReplayMember(discord.Member):
+        def __init__(self, member_id: int, joined_at: datetime.datetime, role_ids: list):
+            self.member_id = member_id
+            self.joined_at = joined_at
+            self.role_objects = [discord.Object(id=role_id) for role_id in role_ids]
+
+        @property
+        def id(self):
+            return self.member_id
+
+        @property
+        def bot(self):
+            return False
+
+        @property
+        def mention(self):
+            return f'<@{self.member_id}>'
+
+        @property
+        def roles(self):
+            return self.role_objects
+
+        def get_role(self, role_id: int):
+            return next((role for role in self.role_objects if role.id == role_id), None)
+
+        def __eq__(self, other):
+            return getattr(other, 'id', None) == self.member_id
+
+        def __hash__(self):
+            return self.member_id
+
+        async def add_roles(self, *roles, reason=None, atomic=True):
+            pass
+
+    class ReplayChannel:
+        def __init__(self, channel_id: int):
+            self.id = channel_id
+            self.name = str(channel_id)
+            self.mention = f'<#{channel_id}>'
+
+        async def send(self, *args, **kwargs):
+            pass
+
+    class ReplayMessage:
+        __slots__ = ('id', 'author', 'channel', 'content', 'attachments', 'created_at')
+
+        def __init__(self, message_id: int, author, channel, content: str, created_at: datetime.datetime):
+            self.id = message_id
+            self.author = author
+            self.channel = channel
+            self.content = content
+            self.attachments = []
+            self.created_at = created_at
+
+        async def delete(self):
+            pass
+
+    class ReplayGuild:
+        def __init__(self):
+            self.members_by_id = {}
+            self.channels_by_id = {}
+
+        @property
+        def members(self):
+            return list(self.members_by_id.values())
+
+        def get_member(self, member_id: int):
+            return self.members_by_id.get(member_id)
+
+        def get_channel(self, channel_id: int):
+            if channel_id not in self.channels_by_id:
+                self.channels_by_id[channel_id] = ReplayChannel(channel_id)
+            return self.channels_by_id[channel_id]
+
+        get_channel_or_thread = get_channel
+
+    class ReplayBot:
+        def __init__(self, guild: ReplayGuild):
+            self.guild = guild
+            self.user = discord.Object(id=REPLAY_BOT_USER_ID)
+            self.config = STARTUP_CONFIG
+
+        def get_guild(self, guild_id: int):
+            return self.guild
+
+        async def log(self, **kwargs):
+            pass
+
+    decisions = []
+    message_index = 0
+
+    class ReplayAutoBanningCog(auto_banning.AutoBanningCog):
+        def queue_ban_action(self, action, *args) -> None:
+            """Record the decision instead of carrying it out, nothing is sent anywhere."""
+            if action.__name__ == 'ban_cluster':
+                user_ids = sorted(member.id for member in args[0])
+            elif action.__name__ == 'ban_new_user':
+                user_ids = [args[0].author.id]
+            else:
+                user_ids = [args[0].id]
+            decisions.append({'message': message_index, 'action': action.__name__, 'user_ids': user_ids})
+
+    guild = ReplayGuild()
+    for record in stream:
+        if record['author_id'] not in guild.members_by_id:
+            guild.members_by_id[record['author_id']] = ReplayMember(
+                record['author_id'],
+                datetime.datetime.fromtimestamp(record['joined_at'], tz=datetime.timezone.utc),
+                record.get('role_ids', []))
+
+    now = datetime.datetime.fromtimestamp(stream[0]['timestamp'] if stream else 0, tz=datetime.timezone.utc)
+    real_utcnow = discord.utils.utcnow
+    discord.utils.utcnow = lambda: now
+    latencies = []
+    peak_memory = None
+    with tempfile.TemporaryDirectory() as state_directory:
+        cog = ReplayAutoBanningCog(ReplayBot(guild))
+        # keep the replay's state out of data/moderation
+        cog.state_store = auto_banning.AutoBanStateStore(state_directory)
+        try:
+            await cog.on_ready()
+            if measure_memory:
+                tracemalloc.start()
+            for message_index, record in enumerate(stream):
+                now = datetime.datetime.fromtimestamp(record['timestamp'], tz=datetime.timezone.utc)
+                message = ReplayMessage(
+                    message_index + 1, guild.get_member(record['author_id']), guild.get_channel(record['channel_id']),
+                    record['content'], now)
+                start = time.perf_counter()
+                await cog.on_message(message)
+                latencies.append(time.perf_counter() - start)
+            if measure_memory:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        finally:
+            await cog.cog_unload()
+            discord.utils.utcnow = real_utcnow
+    return {'decisions': decisions, 'latencies': latencies, 'peak_memory': peak_memory}
+
+
+async def main() -> int:
+    arguments = parse_arguments()
+    if not arguments.use_env:
+        os.environ.update(REPLAY_ENVIRONMENT)
+    sys.path.insert(0, REPOSITORY_DIR)
+    from cogs.moderation import auto_banning
+
+    if arguments.stream:
+        with open(arguments.stream, 'r') as file:
+            stream = [json.loads(line) for line in file if line.strip()]
+    else:
+        stream = generate_synthetic_stream(arguments.messages, arguments.authors, arguments.channels, arguments.seed)
+    if arguments.write_stream:
+        with open(arguments.write_stream, 'w') as file:
+            file.writelines(json.dumps(record) + '\n' for record in stream)
+
+    # latency is measured without tracemalloc, which slows everything down, and memory in a second pass
+    timed_result = await replay(auto_banning, stream, measure_memory=False)
+    memory_result = await replay(auto_banning, stream, measure_memory=True)
+    decisions = timed_result['decisions']
+    latencies = sorted(timed_result['latencies'])
+    total_seconds = sum(latencies)
+    print(f'messages:        {len(stream)}')
+    if latencies:
+        print(f'messages/second: {len(stream) / total_seconds:.0f}')
+        print(f'p50 latency:     {percentile(latencies, 0.5) * 1e6:.1f} us')
+        print(f'p99 latency:     {percentile(latencies, 0.99) * 1e6:.1f} us')
+    print(f'peak memory:     {memory_result["peak_memory"] / 1024 / 1024:.2f} MiB')
+    print(f'ban decisions:   {len(decisions)} ({sum(len(decision["user_ids"]) for decision in decisions)} users)')
+    if memory_result['decisions'] != decisions:
+        print('FAIL: the two passes over the same stream made different decisions')
+        return 1
+
+    if not arguments.stream:
+        # the synthetic regular authors never spam, whatever the golden file says
+        regular_author_ids = range(10000, 10000 + arguments.authors)
+        banned_regular_author_ids = sorted({user_id for decision in decisions for user_id in decision['user_ids']
+                                            if user_id in regular_author_ids})
+        if banned_regular_author_ids:
+            print(f'FAIL: regular authors were banned: {banned_regular_author_ids}')
+            return 1
+
+    golden_path = arguments.golden
+    if golden_path is None and not arguments.stream:
+        default_stream = (arguments.messages, arguments.authors, arguments.channels, arguments.seed) == (20000, 500, 20, 0)
+        golden_path = GOLDEN_PATH if default_stream else None
+    if arguments.use_env or golden_path is None:
+        return 0
+    if arguments.update_golden:
+        with open(golden_path, 'w') as file:
+            json.dump(decisions, file, indent=1)
+            file.write('\n')
+        print(f'wrote {golden_path}')
+        return 0
+    with open(golden_path, 'r') as file:
+        golden_decisions = json.load(file)
+    if decisions == golden_decisions:
+        print('decisions match the golden file')
+        return 0
+    print('FAIL: decisions differ from the golden file')
+    golden_set = {json.dumps(decision, sort_keys=True) for decision in golden_decisions}
+    current_set = {json.dumps(decision, sort_keys=True) for decision in decisions}
+    for decision in sorted(golden_set - current_set):
+        print(f'  missing:    {decision}')
+    for decision in sorted(current_set - golden_set):
+        print(f'  unexpected: {decision}')
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))